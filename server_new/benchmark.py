@@ -0,0 +1,415 @@
+"""
+Microbenchmarks for the server components: protocol parsing/packing, cksum, crypto helpers and database methods.
+
+Run from the repository root:
+    python server_new/benchmark.py                      # run, compare with the committed baseline
+    python server_new/benchmark.py --update-baseline    # run and store the results as the new baseline
+Exits with 1 when a benchmark got slower than the baseline by more than the threshold. To tell regressions from noise,
+baseline times are scaled by how fast this machine runs the reference workload compared to the machine that
+recorded them, benchmarks below SMALL seconds get twice the threshold, and groups with a suspected regression are
+run again: only a slowdown seen in every run is reported.
+"""
+import argparse
+import json
+import logging
+import os
+import secrets
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import timeit
+import uuid
+from datetime import datetime
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import cksum
+import config
+import database
+import durability
+import helpers
+import protocol
+
+config = config.get()
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+SEED_CLIENTS = 10000  # rows seeded into the benchmark database.
+PAYLOAD_SIZES = (1024, 64 * 1024, 1024 * 1024)
+REFERENCE = "reference"  # result name of the machine speed reference.
+SMALL = 10e-6  # benchmarks faster than this get a doubled threshold.
+RETRIES = 2  # reruns of groups with suspected regressions.
+
+
+def measure(fn, repeat=7):
+    """ Return the median time of a single fn() call in seconds, over repeat rounds of at least 0.2 seconds. """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def measure_each(setup, fn, repeat=7, number=10):
+    """ Like measure, for calls that use up what they work on (e.g. deletes): setup() prepares the argument of every
+    fn call and isn't timed. Return the median over repeat rounds of the mean time of number calls. """
+    rounds = []
+    for _ in range(repeat):
+        elapsed = 0.0
+        for _ in range(number):
+            argument = setup()
+            start = time.perf_counter()
+            fn(argument)
+            elapsed += time.perf_counter() - start
+        rounds.append(elapsed / number)
+    return statistics.median(rounds)
+
+
+def reference():
+    """ Time a fixed pure Python workload; it tells how fast the machine is compared to the baseline's. """
+    values = list(range(1000))
+    return measure(lambda: sorted(values, key=lambda value: -value))
+
+
+def header(code, payload_size, client_id=b"\x01" * 16):
+    return client_id + struct.pack("<BHL", config.server_version, code, payload_size)
+
+
+def padded(text, size):
+    return text.ljust(size, b"\0")
+
+
+def bench_protocol():
+    name = padded(b"benchmark", config.name_size)
+    file_name = padded(b"file.txt", config.file_name_size)
+    public_key = secrets.token_bytes(config.public_key_size)
+    content = secrets.token_bytes(config.packet_size - config.client_id_size - config.header_size -
+                                  config.content_size - config.file_name_size)
+    requests = {
+        "RegistrationRequest": (protocol.RegistrationRequest, header(config.registration_request, len(name)) + name),
+        "SendingPublicKeyRequest": (protocol.SendingPublicKeyRequest,
+                                    header(config.sending_public_key, len(name) + len(public_key)) + name + public_key),
+        "ReconnectionRequest": (protocol.ReconnectionRequest, header(config.reconnection_request, len(name)) + name),
+        "ValidCRCRequest": (protocol.ValidCRCRequest, header(config.valid_crc, len(file_name)) + file_name),
+        "InvalidCRCRequest": (protocol.InvalidCRCRequest, header(config.non_valid_crc, len(file_name)) + file_name),
+        "FileHashCheckRequest": (protocol.FileHashCheckRequest,
+                                 header(config.file_hash_check, 4 + len(file_name) + config.content_hash_size) +
+                                 struct.pack("<L", 1024) + file_name + secrets.token_bytes(config.content_hash_size)),
+    }
+    results = {}
+    for request_name, (request_class, data) in requests.items():
+        data = memoryview(bytearray(data))
+        results[f"protocol.{request_name}.unpack"] = measure(lambda: request_class().unpack(data))
+
+    # a file request whose content fits the first packet, so unpack doesn't touch the connection
+    file_data = memoryview(bytearray(header(config.sending_file, 4 + len(file_name) + len(content)) +
+                                     struct.pack("<L", len(content)) + file_name + content))
+    results["protocol.SendingFileRequest.unpack"] = measure(
+        lambda: protocol.SendingFileRequest().unpack(NullConnection(), file_data))
+
+    def response(response_class, **fields):
+        instance = response_class()
+        for field, value in fields.items():
+            setattr(instance, field, value)
+        return instance
+
+    client_id = secrets.token_bytes(config.client_id_size)
+    aes_key = secrets.token_bytes(config.aes_key_size)
+    responses = {
+        "ResponseHeader": protocol.ResponseHeader(config.general_error_response),
+        "RegistrationResponse": response(protocol.RegistrationResponse, clientID=client_id),
+        "SendingPublicKeyResponse": response(protocol.SendingPublicKeyResponse, clientID=client_id, aes_key=aes_key),
+        "ReconnectionResponse": response(protocol.ReconnectionResponse, clientID=client_id, aes_key=aes_key),
+        "SendingFileResponse": response(protocol.SendingFileResponse, clientID=client_id, content_size=1024,
+                                        cksum=12345),
+        "CRCResponse": response(protocol.CRCResponse, clientID=client_id),
+        "FileContentUnknownResponse": response(protocol.FileContentUnknownResponse, clientID=client_id),
+    }
+    for response_name, instance in responses.items():
+        results[f"protocol.{response_name}.pack"] = measure(instance.pack)
+    return results
+
+
+class NullConnection:
+    """ Stand-in connection for requests that are fully contained in their first packet. """
+
+    def settimeout(self, timeout):
+        pass
+
+
+def bench_cksum():
+    results = {}
+    for size in PAYLOAD_SIZES:
+        payload = secrets.token_bytes(size)
+        results[f"cksum.memcrc.{size}"] = measure(lambda: cksum.memcrc(payload), repeat=5)
+    return results
+
+
+def bench_crypto():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+    public_key = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                       serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    aes_key = helpers.generate_aes_key()
+    results = {"helpers.encrypt_aes_key": measure(lambda: helpers.encrypt_aes_key(aes_key, public_key))}
+    for size in PAYLOAD_SIZES:
+        payload = secrets.token_bytes(size)
+        results[f"helpers.decrypt_file_content.{size}"] = measure(
+            lambda: helpers.decrypt_file_content(payload, aes_key))
+    return results
+
+
+def seed(db, count):
+    """ Fill db with count clients, each with one stored file. """
+    rows = []
+    for i in range(count):
+        client_id = uuid.uuid4().bytes
+        rows.append((client_id, f"client{i}"))
+    for shard in db.shards:
+        conn = db.connect(shard)
+        conn.executemany(f"INSERT INTO {database.Database.CLIENTS} (ID, Name, PublicKey, LastSeen, AESKey) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(cid, name, secrets.token_bytes(config.public_key_size), str(datetime.now()),
+                           secrets.token_bytes(config.aes_key_size)) for cid, name in rows if db.shard(cid) == shard])
+        conn.executemany(f"INSERT INTO {database.Database.FILES} (ID, FileName, PathName, Verified, Uploaded) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(cid, f"{name}.txt", f"/tmp/{name}.txt", False, datetime.now()) for cid, name in rows
+                          if db.shard(cid) == shard])
+        conn.commit()
+        conn.close()
+    conn = db.connect()
+    conn.executemany(f"INSERT INTO {database.Database.NAMES} (Name, ID) VALUES (?, ?)",
+                     [(name, cid) for cid, name in rows])
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def bench_database():
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        db = database.Database(os.path.join(directory, "benchmark.db"))
+        db.initialize()
+        rows = seed(db, SEED_CLIENTS)
+        client_id, name = rows[len(rows) // 2]
+        public_key = secrets.token_bytes(config.public_key_size)
+        aes_key = secrets.token_bytes(config.aes_key_size)
+        content_hash = secrets.token_bytes(config.content_hash_size)
+        db.store_content(content_hash, 1024, "/tmp/stored.txt", 12345)
+        durability.flusher.attach(db)
+        counter = iter(range(10 ** 9))
+
+        def new_client():
+            return database.Client(uuid.uuid4().hex, f"new{next(counter)}", str(datetime.now()),
+                                   secrets.token_bytes(config.public_key_size), aes_key)
+
+        def new_file():
+            return database.File(uuid.uuid4().hex, "new.txt", "/tmp/new.txt", False)
+
+        shard = db.shard(client_id)
+        batch = config.maintenance_batch_size
+
+        def unverified_files():
+            """ A batch of expired unverified files of client_id, as maintenance finds them """
+            keys = [(client_id, f"expired{next(counter)}.txt") for _ in range(batch)]
+            conn = db.connect(shard)
+            conn.executemany(f"INSERT INTO {database.Database.FILES} (ID, FileName, PathName, Verified, Uploaded) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(cid, file_name, f"/tmp/{file_name}", False, datetime(2000, 1, 1))
+                              for cid, file_name in keys])
+            conn.commit()
+            conn.close()
+            return keys
+
+        def unreferenced_content():
+            path_name = f"/tmp/removed{next(counter)}.txt"
+            db.store_content(secrets.token_bytes(config.content_hash_size), 1024, path_name, 1)
+            return path_name
+
+        def stale_clients():
+            """ A batch of clients of shard last seen long ago, as maintenance finds them """
+            clients = []
+            while len(clients) < batch:
+                cid = uuid.uuid4().bytes
+                if db.shard(cid) == shard:
+                    clients.append((cid, f"stale{next(counter)}"))
+            conn = db.connect(shard)
+            conn.executemany(f"INSERT INTO {database.Database.CLIENTS} (ID, Name, PublicKey, LastSeen, AESKey) "
+                             "VALUES (?, ?, ?, ?, ?)", [(cid, client_name, public_key, str(datetime(2000, 1, 1)),
+                                                         aes_key) for cid, client_name in clients])
+            conn.commit()
+            conn.close()
+            conn = db.connect()
+            conn.executemany(f"INSERT INTO {database.Database.NAMES} (Name, ID) VALUES (?, ?)",
+                             [(client_name, cid) for cid, client_name in clients])
+            conn.commit()
+            conn.close()
+            return clients
+
+        def free_pages():
+            """ Leave about maintenance_vacuum_pages free pages in shard, by adding and deleting file entries filling a
+            page each """
+            keys = [(client_id, f"vacuumed{next(counter)}.txt") for _ in range(config.maintenance_vacuum_pages)]
+            conn = db.connect(shard)
+            conn.executemany(f"INSERT INTO {database.Database.FILES} (ID, FileName, PathName, Verified, Uploaded) "
+                             "VALUES (?, ?, ?, ?, ?)", [(cid, file_name, "/tmp/" + "x" * 3000, False, datetime.now())
+                                                        for cid, file_name in keys])
+            conn.commit()
+            conn.close()
+            db.delete_files(shard, keys)
+            return shard
+
+        calls = {
+            "client_username_exists": lambda: db.client_username_exists(name),
+            "store_client": lambda: db.store_client(new_client()),
+            "update_public_key": lambda: db.update_public_key(client_id, public_key),
+            "update_aes_key": lambda: db.update_aes_key(client_id, aes_key),
+            "update_last_seen": lambda: db.update_last_seen(client_id, datetime.now()),
+            "get_client_name": lambda: db.get_client_name(client_id),
+            "get_aes_key": lambda: db.get_aes_key(client_id),
+            "get_public_key": lambda: db.get_public_key(client_id),
+            "file_details": lambda: db.file_details(new_file()),
+            "get_stored_content": lambda: db.get_stored_content(content_hash, 1024),
+            "store_content": lambda: db.store_content(secrets.token_bytes(config.content_hash_size), 1024,
+                                                      "/tmp/new.txt", 1),
+            "update_verified_true": lambda: db.update_verified_true(client_id, f"{name}.txt"),
+            # maintenance and cksum cross-checking; an unreferenced path is the common (and slowest) case
+            "get_unverified_files": lambda: db.get_unverified_files(shard, datetime.now(), batch),
+            "path_referenced": lambda: not db.path_referenced("/tmp/unreferenced.txt"),
+            "get_stale_clients": lambda: db.get_stale_clients(shard, datetime.now(), batch),
+            "get_content_cksum": lambda: db.get_content_cksum("/tmp/stored.txt"),
+            "update_verified_false": lambda: db.update_verified_false(f"/tmp/{name}.txt"),
+        }
+        for method, call in calls.items():
+            if not call():
+                raise RuntimeError(f"Database.{method} failed on the benchmark database")
+            results[f"database.{method}"] = measure(call)
+        # calls using up their rows, given a fresh batch each time
+        consuming = {
+            "delete_files": (unverified_files, lambda keys: db.delete_files(shard, keys)),
+            "delete_content": (unreferenced_content, db.delete_content),
+            "archive_clients": (stale_clients, lambda clients: db.archive_clients(shard, clients, datetime.now())),
+            "incremental_vacuum": (free_pages,
+                                   lambda vacuumed: db.incremental_vacuum(vacuumed, config.maintenance_vacuum_pages)),
+        }
+        for method, (setup, call) in consuming.items():
+            if not call(setup()):
+                raise RuntimeError(f"Database.{method} failed on the benchmark database")
+            results[f"database.{method}"] = measure_each(setup, call)
+        durability.flusher.detach()
+    return results
+
+
+def bench_durability():
+    results = {}
+    mode = config.durability
+    payload = secrets.token_bytes(64 * 1024)
+    try:
+        for durability_mode in config.DURABILITY_MODES:
+            config.durability = durability_mode
+            with tempfile.TemporaryDirectory() as directory:
+                db = database.Database(os.path.join(directory, "durability.db"))
+                db.initialize()
+                client_id, _ = seed(db, 100)[0]
+                file_name = f"benchmark-durability-{os.getpid()}"
+                durability.flusher.attach(db)
+                results[f"durability.{durability_mode}.save_to_ram.65536"] = measure(
+                    lambda: helpers.save_to_ram(payload, file_name), repeat=5)
+                results[f"durability.{durability_mode}.update_last_seen"] = measure(
+                    lambda: db.update_last_seen(client_id, datetime.now()), repeat=5)
+                if durability_mode == durability.BATCHED:
+                    def write_and_flush():
+                        helpers.save_to_ram(payload, file_name)
+                        db.update_last_seen(client_id, datetime.now())
+                        durability.flusher.flush()
+                    results["durability.batched.write_and_flush"] = measure(write_and_flush, repeat=5)
+                durability.flusher.detach()
+                os.remove(f"/tmp/{file_name}")
+    finally:
+        config.durability = mode
+    return results
+
+
+GROUPS = {
+    "protocol": bench_protocol,
+    "cksum": bench_cksum,
+    "crypto": bench_crypto,
+    "database": bench_database,
+    "durability": bench_durability,
+}
+
+
+def run(groups):
+    """ Run the given groups, return their results and the group of each result. The reference is measured before
+    each group, and the fastest of those kept, as the machine's speed drifts while the benchmarks run. """
+    results = {}
+    owners = {}
+    references = []
+    for group in groups:
+        references.append(reference())
+        for name, seconds in GROUPS[group]().items():
+            results[name] = seconds
+            owners[name] = group
+    results[REFERENCE] = min(references)
+    return results, owners
+
+
+def compare(results, baseline, threshold):
+    """ Return (name, scaled baseline, current) for every benchmark slower than its baseline, scaled to this machine's
+    speed, by more than threshold (twice the threshold below SMALL seconds). """
+    speed = 1.0
+    if REFERENCE in results and REFERENCE in baseline:
+        speed = results[REFERENCE] / baseline[REFERENCE]
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        if name == REFERENCE or name not in baseline:
+            continue
+        expected = baseline[name] * speed
+        allowed = threshold * 2 if expected < SMALL else threshold
+        if seconds > expected * (1 + allowed):
+            regressions.append((name, expected, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run server microbenchmarks and compare them with a baseline.")
+    parser.add_argument("--group", action="append", choices=sorted(GROUPS), help="run only these groups")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown ratio (default 0.25)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the baseline")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)  # failures are reported by the benchmarks themselves
+
+    results, owners = run(args.group or GROUPS)
+    for name, seconds in sorted(results.items()):
+        print(f"{name:60} {seconds * 1e6:12.2f} us")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, nothing to compare.")
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for _ in range(RETRIES):
+        if not regressions:
+            break
+        suspects = sorted({owners[name] for name, _, _ in regressions})
+        print(f"Running {', '.join(suspects)} again to confirm {len(regressions)} possible regression(s).")
+        rerun, _ = run(suspects)
+        for name, seconds in rerun.items():
+            results[name] = min(results[name], seconds)
+        regressions = compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print(f"REGRESSION {name}: {before * 1e6:.2f} us -> {after * 1e6:.2f} us ({after / before - 1:+.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import logging
+import threading
+
+import config
+
+config = config.get()
+
+
+class BufferPool:
+    """ Reusable receive buffers, with per-connection accounting and a global cap on buffered bytes. """
+
+    def __init__(self, buffer_size, max_free=None, max_bytes=None):
+        self.buffer_size = buffer_size
+        self.max_free = config.buffer_pool_size if max_free is None else max_free
+        self.max_bytes = config.max_buffered_bytes if max_bytes is None else max_bytes
+        self.free = []
+        self.in_use = 0  # bytes currently handed out or reserved, over all connections.
+        self.usage = {}  # conn -> bytes currently handed out or reserved for it.
+        self.lock = threading.Lock()
+
+    def charge(self, conn, size):
+        """ Account size bytes to conn, return False if that would exceed the global cap. """
+        if self.in_use + size > self.max_bytes:
+            logging.warning("Buffer cap reached (%s of %s bytes), refusing %s bytes.", self.in_use, self.max_bytes,
+                            size)
+            return False
+        self.in_use += size
+        self.usage[conn] = self.usage.get(conn, 0) + size
+        return True
+
+    def credit(self, conn, size):
+        """ Give size bytes accounted to conn back. """
+        self.in_use -= size
+        left = self.usage.get(conn, 0) - size
+        if left > 0:
+            self.usage[conn] = left
+        else:
+            self.usage.pop(conn, None)
+
+    def acquire(self, conn):
+        """ Get a receive buffer for conn, or None when the global cap is reached. """
+        with self.lock:
+            if not self.charge(conn, self.buffer_size):
+                return None
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, conn, buffer):
+        """ Return a buffer taken with acquire. """
+        with self.lock:
+            self.credit(conn, self.buffer_size)
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+    def reserve(self, conn, size):
+        """ Account a payload of size bytes buffered outside the pool, return whether it fits the cap. """
+        with self.lock:
+            return self.charge(conn, size)
+
+    def unreserve(self, conn, size):
+        """ Give back a reservation made with reserve. """
+        with self.lock:
+            self.credit(conn, size)
+
+    def buffered(self, conn=None):
+        """ Bytes currently buffered for conn, or over all connections. """
+        with self.lock:
+            if conn is None:
+                return self.in_use
+            return self.usage.get(conn, 0)
@@ -3,8 +3,19 @@ This module implements the cksum command found in most UNIXes in pure
 python.
 
 The constants and routine are cribbed from the POSIX man page
+
+Usage: python cksum.py [-j JOBS] [--check-db DATABASE] PATH [PATH ...]
+Directories are walked recursively and files are checksummed in parallel, in constant memory.
 """
+import argparse
+import mmap
+import os
+import sqlite3
 import sys
+from multiprocessing import Pool
+
+import config
+import database
 
 crctab = [ 0x00000000, 0x04c11db7, 0x09823b6e, 0x0d4326d9, 0x130476dc,
         0x17c56b6b, 0x1a864db2, 0x1e475005, 0x2608edb8, 0x22c9f00f,
@@ -60,31 +71,126 @@ crctab = [ 0x00000000, 0x04c11db7, 0x09823b6e, 0x0d4326d9, 0x130476dc,
         0xb1f740b4 ]
 
 UNSIGNED = lambda n: n & 0xffffffff
+CHUNK_SIZE = 1024 * 1024
 
-def memcrc(b):
-    n = len(b)
-    i = c = s = 0
+def crcupdate(s, b):
     for ch in b:
         tabidx = (s>>24)^ch
         s = UNSIGNED((s << 8)) ^ crctab[tabidx]
+    return s
 
+def crcfinish(s, n):
     while n:
         c = n & 0o377
         n = n >> 8
         s = UNSIGNED(s << 8) ^ crctab[(s >> 24) ^ c]
     return UNSIGNED(~s)
 
-def readfile(fname):
+def memcrc(b):
+    return crcfinish(crcupdate(0, b), len(b))
+
+def filecrc(fname):
+    """ cksum of a file, mapped and processed chunk by chunk so memory use doesn't grow with file size """
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        s = 0
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for offset in range(0, size, CHUNK_SIZE):
+                    s = crcupdate(s, m[offset:offset + CHUNK_SIZE])
+    return crcfinish(s, size), size
+
+def checkfile(fname):
+    """ Return (fname, crc, size, error); never raises so one bad file doesn't abort a run """
     try:
-        buffer = open(fname, 'rb').read()
-        return f"{memcrc(buffer)}\t{len(buffer)}\t{fname}"
-    except IOError:
-        print ("Unable to open input file", fname)
-        exit (-1)
+        crc, size = filecrc(fname)
+        return fname, crc, size, None
     except Exception as err:
-        print ("Error processing the file", err)
-        exit (-1)
+        return fname, None, None, str(err)
+
+def readfile(fname):
+    fname, crc, size, error = checkfile(fname)
+    if error:
+        return f"Error processing the file {fname}: {error}"
+    return f"{crc}\t{size}\t{fname}"
+
+def expand(paths):
+    """ Yield the given files and every file below the given directories """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+def crosscheck(db, fname, crc):
+    """ Compare crc with the cksum recorded for fname, marking its files entries unverified on mismatch """
+    for path in (fname, os.path.abspath(fname)):
+        recorded = db.get_content_cksum(path)
+        if recorded is not None:
+            break
+    else:
+        return "UNKNOWN"
+    if recorded == crc:
+        return "OK"
+    db.update_verified_false(path)
+    return f"MISMATCH (recorded {recorded})"
+
+def checkdb(db):
+    """ Return why db can't be cross-checked against, or None. Opened read-only, so a mistyped path isn't created """
+    for shard in db.shards:
+        if not os.path.isfile(shard):
+            return f"{shard}: no such database file"
+        try:
+            conn = sqlite3.connect(f"file:{shard}?mode=ro", uri=True)
+            try:
+                tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            return f"{shard}: {err}"
+        missing = {db.CONTENTS, db.FILES} - tables
+        if missing:
+            return f"{shard}: missing table(s) {', '.join(sorted(missing))}"
+    return None
+
+def positive(value):
+    """ argparse type for counts that must be at least 1 """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def main():
+    parser = argparse.ArgumentParser(description="POSIX cksum of files and directories, in parallel.")
+    parser.add_argument("paths", nargs="+", help="files or directories to checksum")
+    parser.add_argument("-j", "--jobs", type=positive, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--check-db", metavar="DATABASE",
+                        help="cross-check against the cksums recorded in this database, marking mismatches")
+    parser.add_argument("--shards", type=positive, default=None, help="shard count of the database")
+    args = parser.parse_args()
+    db = None
+    if args.check_db:
+        db = database.Database(args.check_db, args.shards or config.get().db_shards)
+        error = checkdb(db)
+        if error:
+            print(f"Can't check against the database: {error}", file=sys.stderr)
+            return 2
+    failed = 0
+    with Pool(args.jobs) as pool:
+        for fname, crc, size, error in pool.imap(checkfile, expand(args.paths), chunksize=4):
+            if error:
+                failed += 1
+                print(f"Error processing the file {fname}: {error}", file=sys.stderr)
+                continue
+            line = f"{crc}\t{size}\t{fname}"
+            if db is not None:
+                line += "\t" + crosscheck(db, fname, crc)
+            print(line)
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
-    print (readfile(sys.argv[-1]))
+    sys.exit(main())
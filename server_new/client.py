@@ -1,17 +1,17 @@
 import config
 
-config = config.Config()
+config = config.get()
 
 
 class Client:
     """ Client entry """
 
-    def __init__(self, cid, cname, last_seen=None, public_key=None, aes_key=None):
+    def __init__(self, cid, cname, last_seen=None, public_key=b"", aes_key=b""):
         self.ID = bytes.fromhex(cid)  # UID, 16 bytes.
         self.Name = cname  # Client's name, 255 characters.
-        self.PublicKey = public_key  # Client's public key, 160 bytes.
+        self.PublicKey = public_key  # Client's public key, 160 bytes; empty until the keys are exchanged.
         self.LastSeen = last_seen  # date & time of client's last request.
-        self.AESKey = aes_key  # 128 bits
+        self.AESKey = aes_key  # 128 bits; empty until the keys are exchanged.
 
     def validate_client(self):
         """ Validating Client attributes """
@@ -19,10 +19,10 @@ class Client:
             return False
         if not self.Name or len(self.Name) >= config.name_size:
             return False
-        if not self.PublicKey or len(self.PublicKey) != config.public_key_size:
+        if self.PublicKey is None or len(self.PublicKey) not in (0, config.public_key_size):
             return False
         if not self.LastSeen:
             return False
-        if not self.AESKey or len(self.AESKey) != config.aes_key_size:
+        if self.AESKey is None or len(self.AESKey) not in (0, config.aes_key_size):
             return False
         return True
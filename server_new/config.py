@@ -1,4 +1,50 @@
+import json
+import logging
+import os
+import re
+import threading
+
+CONFIG_FILE = "server_new/server.json"  # overridden by the SERVER_CONFIG environment variable.
+ENV_PREFIX = "SERVER_"  # e.g. SERVER_IDLE_TIMEOUT=120 sets idle_timeout.
+
+
 class Config:
+    # Settings that may be changed from the config file or environment; everything else is protocol definition.
+    TUNABLES = (
+        "database", "packet_size", "max_connections", "db_shards", "db_pragmas",
+        "durability", "durability_flush_interval",
+        "header_timeout", "payload_timeout", "write_timeout", "idle_timeout", "request_timeout",
+        "min_transfer_rate", "min_rate_check_size", "min_rate_grace", "reaper_interval",
+        "buffer_pool_size", "max_buffered_bytes",
+        "maintenance_interval", "unverified_file_retention_hours", "client_archive_after_days",
+        "maintenance_batch_size", "maintenance_batch_pause", "maintenance_vacuum_pages",
+        "log_sample_rate", "log_sample_rates",
+        "trace_file", "trace_file_max_bytes", "trace_file_backups", "trace_sample_rate", "trace_slow_ms",
+        "control_workers", "bulk_workers", "bulk_queue_size", "bulk_payload_threshold",
+    )
+    # Tunables read on every use, so a reload (SIGHUP) takes effect right away; the rest need a restart.
+    RELOADABLE = (
+        "max_connections", "db_pragmas", "durability_flush_interval",
+        "header_timeout", "payload_timeout", "write_timeout", "idle_timeout", "request_timeout",
+        "min_transfer_rate", "min_rate_check_size", "min_rate_grace",
+        "maintenance_interval", "unverified_file_retention_hours", "client_archive_after_days",
+        "maintenance_batch_size", "maintenance_batch_pause", "maintenance_vacuum_pages",
+        "log_sample_rate", "log_sample_rates", "trace_sample_rate", "trace_slow_ms", "bulk_payload_threshold",
+    )
+    RATES = ("log_sample_rate", "trace_sample_rate")
+    # Lowest usable values; other numeric tunables only need to be non-negative. packet_size is checked against
+    # Config.min_packet_size.
+    MINIMUMS = {
+        "max_connections": 1, "db_shards": 1, "control_workers": 1, "bulk_workers": 1, "bulk_queue_size": 1,
+        "maintenance_batch_size": 1,
+    }
+    # Intervals and timeouts, which must be above zero.
+    POSITIVE = (
+        "durability_flush_interval", "header_timeout", "payload_timeout", "write_timeout", "idle_timeout",
+        "request_timeout", "reaper_interval", "maintenance_interval",
+    )
+    DURABILITY_MODES = ("none", "batched", "strict")
+
     def __init__(self):
         self.default_port = 1357
         self.server_version = 3
@@ -14,6 +60,58 @@ class Config:
         self.file_name_size = 255
         self.path_name_size = 255
         self.cksum_size = 4
+        self.content_hash_size = 32  # SHA-256 digest of the plain file content.
+        # A request's fixed size fields must fit its first packet; sending public key is the largest.
+        self.min_packet_size = self.client_id_size + self.header_size + self.name_size + self.public_key_size
+
+        self.database = 'defensive.db'
+        self.packet_size = 1024  # size of every packet read from and written to a client.
+        self.max_connections = 1000  # open client connections; further ones are refused.
+        self.durability = 'strict'  # none, batched or strict; see durability.py for the guarantees.
+        self.durability_flush_interval = 1.0  # seconds between fsyncs in batched mode.
+        self.db_pragmas = {}  # PRAGMA name -> value applied to every database connection, e.g. {"cache_size": -8000}.
+
+        # Timeouts (seconds) per connection phase. Durations in seconds are floats, whole numbers are accepted too.
+        self.header_timeout = 10.0  # waiting for a request header.
+        self.payload_timeout = 30.0  # waiting for each chunk of a file payload.
+        self.write_timeout = 10.0  # sending a response.
+        self.idle_timeout = 60.0  # waiting for the next request on an open connection.
+        self.request_timeout = 600.0  # whole handling of a single request.
+        self.min_transfer_rate = 16 * 1024  # bytes per second, enforced on large uploads only.
+        self.min_rate_check_size = 1024 * 1024  # uploads from this size on must keep the minimum rate.
+        self.min_rate_grace = 5.0  # seconds before the minimum rate is enforced.
+        self.reaper_interval = 5.0  # seconds between stale connection sweeps.
+
+        self.db_shards = 1  # number of SQLite files clients and their files are partitioned across.
+
+        # Receive buffers.
+        self.buffer_pool_size = 256  # free receive buffers kept for reuse.
+        self.max_buffered_bytes = 256 * 1024 * 1024  # cap on bytes buffered over all connections.
+
+        # Retention, enforced by the background maintenance job.
+        self.maintenance_interval = 600.0  # seconds between maintenance runs.
+        self.unverified_file_retention_hours = 24  # unverified uploads older than this are deleted.
+        self.client_archive_after_days = 180  # clients not seen for this long are archived.
+        self.maintenance_batch_size = 100  # rows handled per batch.
+        self.maintenance_batch_pause = 0.5  # seconds between batches.
+        self.maintenance_vacuum_pages = 256  # free pages reclaimed per shard and run.
+
+        # Logging: fraction of success logs kept, per category (request handler name or "connection").
+        self.log_sample_rate = 1.0
+        self.log_sample_rates = {}  # e.g. {"sending_valid_crc_request": 0.1}
+
+        # Tracing.
+        self.trace_file = 'traces.jsonl'
+        self.trace_file_max_bytes = 50 * 1024 * 1024  # rotate the trace file at this size.
+        self.trace_file_backups = 5  # rotated trace files kept.
+        self.trace_sample_rate = 0.01  # fraction of requests traced.
+        self.trace_slow_ms = 1000  # requests at least this slow are always traced.
+
+        # Request scheduling lanes.
+        self.control_workers = 4  # threads reserved for small control requests.
+        self.bulk_workers = 2  # threads handling file transfers.
+        self.bulk_queue_size = 32  # pending bulk requests before new ones are rejected.
+        self.bulk_payload_threshold = 64 * 1024  # payload size from which any request is treated as bulk.
 
         self.registration_request = 1025
         self.sending_public_key = 1026
@@ -22,6 +120,7 @@ class Config:
         self.valid_crc = 1029
         self.non_valid_crc = 1030
         self.non_valid_crc_fourth_time = 1031
+        self.file_hash_check = 1032
 
         self.successful_registration = 2100
         self.registration_failed = 2101
@@ -31,7 +130,95 @@ class Config:
         self.confirm_reconnect_request_send_aes_encrypted = 2105
         self.reconnection_request_rejected = 2106
         self.general_error_response = 2107
+        self.file_content_unknown = 2108
+
+    def validate(self, values):
+        """ Check tunable values against the types and ranges of the defaults, return a list of errors. """
+        errors = []
+        default_config = Config()
+        for name, value in values.items():
+            if name not in Config.TUNABLES:
+                errors.append(f"{name}: unknown setting")
+                continue
+            default = getattr(default_config, name)
+            if isinstance(default, float) and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            if type(value) is not type(default):
+                errors.append(f"{name}: expected {type(default).__name__}, got {value!r}")
+            elif name == "packet_size" and value < default_config.min_packet_size:
+                errors.append(f"{name}: must be at least {default_config.min_packet_size}")
+            elif name == "max_buffered_bytes" and value < default_config.min_packet_size:
+                errors.append(f"{name}: must hold at least one packet ({default_config.min_packet_size})")
+            elif name in Config.MINIMUMS and value < Config.MINIMUMS[name]:
+                errors.append(f"{name}: must be at least {Config.MINIMUMS[name]}")
+            elif name in Config.POSITIVE and value <= 0:
+                errors.append(f"{name}: must be above zero")
+            elif isinstance(value, (int, float)) and value < 0:
+                errors.append(f"{name}: must not be negative")
+            elif name == "durability" and value not in Config.DURABILITY_MODES:
+                errors.append(f"{name}: must be one of {', '.join(Config.DURABILITY_MODES)}")
+            elif name in Config.RATES and value > 1:
+                errors.append(f"{name}: must be between 0 and 1")
+            elif name == "log_sample_rates" and not all(isinstance(rate, (int, float)) and 0 <= rate <= 1
+                                                       for rate in value.values()):
+                errors.append(f"{name}: rates must be between 0 and 1")
+            elif name == "db_pragmas" and not all(re.fullmatch(r"\w+", str(key)) and re.fullmatch(r"-?\w+", str(val))
+                                                 for key, val in value.items()):
+                errors.append(f"{name}: pragma names and values must be plain words or numbers")
+        return errors
+
+    def read(self, path=None):
+        """ Read tunables from the config file (if present), then from the environment. Raise ValueError when
+        anything is invalid. """
+        path = path or os.environ.get("SERVER_CONFIG", CONFIG_FILE)
+        values = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    values.update(json.load(f))
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}")
+        for name in Config.TUNABLES:
+            raw = os.environ.get(ENV_PREFIX + name.upper())
+            if raw is not None:
+                try:
+                    values[name] = json.loads(raw)
+                except ValueError:
+                    values[name] = raw  # plain strings, e.g. a file name
+        errors = self.validate(values)
+        if errors:
+            raise ValueError("invalid configuration: " + "; ".join(errors))
+        return values
+
+    def load(self, path=None):
+        """ Apply all tunables, once at startup """
+        for name, value in self.read(path).items():
+            setattr(self, name, value)
+
+    def reload(self, path=None):
+        """ Re-read the tunables and apply the ones safe to change at runtime; keep everything on errors """
+        with reload_lock:
+            try:
+                values = self.read(path)
+            except ValueError as e:
+                logging.error("Configuration reload failed, keeping current settings: %s", e)
+                return False
+            for name in Config.TUNABLES:
+                value = values.get(name, getattr(Config(), name))
+                if value == getattr(self, name):
+                    continue
+                if name in Config.RELOADABLE:
+                    logging.info("Configuration reload: %s = %r", name, value)
+                    setattr(self, name, value)
+                else:
+                    logging.warning("Configuration reload: %s needs a restart, ignoring the new value.", name)
+            return True
 
 
+reload_lock = threading.RLock()  # SIGHUP may arrive while a reload runs
+shared = Config()
 
 
+def get():
+    """ The configuration instance shared by all modules """
+    return shared
@@ -0,0 +1,98 @@
+import logging
+import socket
+import threading
+import time
+
+import config
+
+config = config.get()
+
+
+class ConnectionReaper:
+    """ Track open client connections and close the ones stuck in a phase for too long. """
+    HEADER = 'header'
+    QUEUED = 'queued'  # waiting in a scheduling lane, then being handled.
+    PAYLOAD = 'payload'
+    WRITE = 'write'
+    IDLE = 'idle'
+
+    def __init__(self, interval=None):
+        self.interval = config.reaper_interval if interval is None else interval
+        self.connections = {}  # conn -> [address, phase, phase start time]
+        self.lock = threading.Lock()
+
+    def register(self, conn, address):
+        """ Start tracking a newly accepted connection. """
+        with self.lock:
+            self.connections[conn] = [address, ConnectionReaper.HEADER, time.monotonic()]
+
+    def touch(self, conn, phase):
+        """ Record that a connection moved to a new phase. """
+        with self.lock:
+            entry = self.connections.get(conn)
+            if entry is not None:
+                entry[1] = phase
+                entry[2] = time.monotonic()
+
+    def count(self):
+        """ Number of tracked connections. """
+        with self.lock:
+            return len(self.connections)
+
+    @staticmethod
+    def limit(phase):
+        """ Longest time a connection may stay in the given phase. """
+        return {
+            ConnectionReaper.HEADER: config.header_timeout,
+            ConnectionReaper.QUEUED: config.request_timeout,
+            ConnectionReaper.PAYLOAD: config.request_timeout,
+            ConnectionReaper.WRITE: config.write_timeout,
+            ConnectionReaper.IDLE: config.idle_timeout
+        }[phase]
+
+    @staticmethod
+    def close(conn):
+        """ Close a connection, waking a thread blocked reading or writing it (close alone doesn't). """
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # not connected anymore
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def unregister(self, conn):
+        """ Stop tracking a connection and close it. """
+        with self.lock:
+            self.connections.pop(conn, None)
+        self.close(conn)
+
+    def reap(self):
+        """ Close every connection that exceeded the limit of its current phase. """
+        now = time.monotonic()
+        stale = []
+        with self.lock:
+            for conn, (address, phase, since) in list(self.connections.items()):
+                if now - since > self.limit(phase):
+                    stale.append((conn, address, phase, now - since))
+                    del self.connections[conn]
+        for conn, address, phase, elapsed in stale:
+            logging.warning("Reaping stale connection %s: %s phase took %.1fs.", address, phase, elapsed)
+            self.close(conn)
+        return len(stale)
+
+    def run(self):
+        """ Sweep stale connections every interval. """
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logging.exception("Connection reaper exception: %s", e)
+
+    def start(self):
+        """ Run the reaper in a background daemon thread. """
+        reaper = threading.Thread(target=self.run, name="connection-reaper", daemon=True)
+        reaper.start()
+        return reaper
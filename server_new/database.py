@@ -1,122 +1,329 @@
 import logging
+import os
 import sqlite3
+import threading
+import zlib
+from datetime import datetime
 import config
+import durability
+import tracing
 from client import Client
 from files import File
 
-config = config.Config()
+config = config.get()
 
 
 class Database:
     CLIENTS = 'clients'
     FILES = 'files'
+    CONTENTS = 'contents'
+    NAMES = 'names'
+    CLIENTS_ARCHIVE = 'clients_archive'
+    CONTENT_LOCKS = 64  # stripes of the stored content locks
 
-    def __init__(self, name):
+    def __init__(self, name, shards=None):
+        """ name holds the global name index; with more than one shard, clients, their files and contents
+        are partitioned by key hash into name.0 ... name.N-1 (e.g. defensive.0.db). """
         self.name = name
+        if shards is None:
+            shards = config.db_shards
+        if shards > 1:
+            stem, ext = os.path.splitext(name)
+            self.shards = [f"{stem}.{i}{ext}" for i in range(shards)]
+        else:
+            self.shards = [name]
+        self.content_locks = [threading.Lock() for _ in range(Database.CONTENT_LOCKS)]
 
-    def connect(self):
-        conn = sqlite3.connect(self.name)
+    def shard(self, key):
+        """ Get the shard file holding the given client id or content hash """
+        return self.shards[zlib.crc32(key) % len(self.shards)]
+
+    def content_lock(self, path_name):
+        """ Lock held while stored content is written and referenced, or checked for references and removed """
+        return self.content_locks[zlib.crc32(path_name.encode('utf-8')) % len(self.content_locks)]
+
+    def connect(self, name=None):
+        conn = sqlite3.connect(name or self.name)
         conn.text_factory = bytes
+        pragmas = dict(durability.PRAGMAS[config.durability])
+        pragmas.update(config.db_pragmas)
+        for pragma, value in pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
         return conn
 
-    def execute_script(self, script):
-        conn = self.connect()
+    def execute_script(self, script, name=None):
+        results = None
+        conn = self.connect(name)
         try:
             conn.executescript(script)
             conn.commit()
+            results = True
         except Exception as e:
-            logging.exception(f"Couldn't create Clients and Files tables due to: {e}")
+            logging.exception("Couldn't create Clients and Files tables due to: %s", e)
         conn.close()
+        return results
 
-    def execute(self, query, args, commit=False):
-        """ Given a query and args, execute query, and return the results. """
+    def execute(self, query, args, commit=False, name=None):
+        """ Given a query and args, execute query on the given database file, and return the results. """
         results = None
-        conn = self.connect()
-        try:
-            cur = conn.cursor()
-            cur.execute(query, args)
-            if commit:
-                conn.commit()
-                results = True
-            else:
-                results = cur.fetchall()
-        except Exception as e:
-            logging.exception(f'database execute: {e}')
-        conn.close()
+        with tracing.span("db.execute", statement=query, shard=name or self.name):
+            conn = self.connect(name)
+            try:
+                cur = conn.cursor()
+                cur.execute(query, args)
+                if commit:
+                    conn.commit()
+                    results = True
+                else:
+                    results = cur.fetchall()
+            except Exception as e:
+                logging.exception('database execute: %s', e)
+            conn.close()
         return results
 
     def initialize(self):
-        # Try to create Clients table
+        for shard in self.shards:
+            # Let maintenance reclaim free pages in small steps; an existing file only switches over with a VACUUM
+            auto_vacuum = self.execute("PRAGMA auto_vacuum", [], name=shard)
+            if auto_vacuum and auto_vacuum[0][0] == 0:
+                logging.info("Enabling incremental auto vacuum on %s, rebuilding it once.", shard)
+                self.execute_script("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;", shard)
+            self.execute_script(f"PRAGMA journal_mode = {durability.JOURNAL_MODES[config.durability]};", shard)
+
+            # Try to create Clients table
+            self.execute_script(f"""
+                CREATE TABLE IF NOT EXISTS {Database.CLIENTS}(
+                  ID BLOB(16) PRIMARY KEY NOT NULL,
+                  Name CHAR(255) NOT NULL,
+                  PublicKey BLOB(20) NOT NULL,
+                  LastSeen DATETIME,
+                  AESKey BLOB(16) NOT NULL              
+                );
+                """, shard)
+
+            # Try to create Files table, one entry per client and file name
+            self.execute_script(Database.files_table(Database.FILES), shard)
+            columns = self.execute(f"PRAGMA table_info({Database.FILES})", [], name=shard) or []
+            if b'Uploaded' not in [column[1] for column in columns]:
+                self.execute_script(f"ALTER TABLE {Database.FILES} ADD COLUMN Uploaded DATETIME;", shard)
+            if any(column[1] == b'FileName' and not column[5] for column in columns):
+                # files used to be keyed by client id alone, allowing a single file per client
+                logging.info("Keying %s of %s by client id and file name.", Database.FILES, shard)
+                self.execute_script(f"""
+                    BEGIN;
+                    {Database.files_table("files_migrated")}
+                    INSERT INTO files_migrated (ID, FileName, PathName, Verified, Uploaded)
+                      SELECT ID, FileName, PathName, Verified, Uploaded FROM {Database.FILES};
+                    DROP TABLE {Database.FILES};
+                    ALTER TABLE files_migrated RENAME TO {Database.FILES};
+                    COMMIT;
+                    """, shard)
+            # files stored before the column existed count as uploaded now, so their retention still runs out
+            self.execute(f"UPDATE {Database.FILES} SET Uploaded = ? WHERE Uploaded IS NULL", [datetime.now()], True,
+                         shard)
+
+            # Try to create Clients archive table, holding clients retired by maintenance
+            self.execute_script(f"""
+                CREATE TABLE IF NOT EXISTS {Database.CLIENTS_ARCHIVE} AS SELECT * FROM {Database.CLIENTS} WHERE 0;
+                """, shard)
+
+            # Try to create Contents table (index of stored file contents by hash)
+            self.execute_script(f"""
+                CREATE TABLE IF NOT EXISTS {Database.CONTENTS}(
+                  Hash BLOB(32) PRIMARY KEY NOT NULL,
+                  Size INTEGER NOT NULL,
+                  PathName CHAR(255) NOT NULL,
+                  Cksum INTEGER NOT NULL
+                );
+                """, shard)
+
+        # Try to create the global Names table (client name -> client id)
         self.execute_script(f"""
-            CREATE TABLE IF NOT EXISTS {Database.CLIENTS}(
-              ID BLOB(16) PRIMARY KEY NOT NULL,
-              Name CHAR(255) NOT NULL,
-              PublicKey BLOB(20) NOT NULL,
-              LastSeen DATETIME,
-              AESKey BLOB(16) NOT NULL              
+            CREATE TABLE IF NOT EXISTS {Database.NAMES}(
+              Name CHAR(255) PRIMARY KEY NOT NULL,
+              ID BLOB(16) NOT NULL
             );
             """)
+        if self.shards == [self.name]:
+            # unsharded database: keep the names index in step with clients created before it existed
+            self.execute_script(f"INSERT OR IGNORE INTO {Database.NAMES} SELECT Name, ID FROM {Database.CLIENTS};")
 
-        # Try to create Files table
-        self.execute_script(f"""
-            CREATE TABLE IF NOT EXISTS {Database.FILES}(
-              ID BLOB(16) PRIMARY KEY NOT NULL,
+    @staticmethod
+    def files_table(table):
+        """ Statement creating a files table of the given name """
+        return f"""
+            CREATE TABLE IF NOT EXISTS {table}(
+              ID BLOB(16) NOT NULL,
               FileName CHAR(255) NOT NULL,
               PathName CHAR(255) NOT NULL,
-              Verified BOOLEAN NOT NULL DEFAULT 0
+              Verified BOOLEAN NOT NULL DEFAULT 0,
+              Uploaded DATETIME,
+              PRIMARY KEY (ID, FileName)
             );
-            """)
+            """
 
     def client_username_exists(self, username):
         """ Check whether a username already exists within database """
-        results = self.execute(f"SELECT * FROM {Database.CLIENTS} WHERE Name = ?", [username])
+        results = self.execute(f"SELECT ID FROM {Database.NAMES} WHERE Name = ?", [username])
         if not results:
             return False
         return len(results) > 0
 
     def store_client(self, client):
         """ Store a client into database """
-        if not type(client) is Client or not client.validate():
+        if not type(client) is Client or not client.validate_client():
             return False
-        return self.execute(f"INSERT INTO {Database.CLIENTS} VALUES (?, ?, ?, ?, ?)",
-                            [client.ID, client.Name, client.PublicKey, client.LastSeen, client.AESKey], True)
+        if not self.execute(f"INSERT INTO {Database.NAMES} VALUES (?, ?)", [client.Name, client.ID], True):
+            return False
+        stored = self.execute(f"INSERT INTO {Database.CLIENTS} VALUES (?, ?, ?, ?, ?)",
+                              [client.ID, client.Name, client.PublicKey, client.LastSeen, client.AESKey], True,
+                              self.shard(client.ID))
+        if not stored:
+            self.execute(f"DELETE FROM {Database.NAMES} WHERE Name = ?", [client.Name], True)
+        return stored
 
-    def update_public_key(self, client_id):
+    def update_public_key(self, client_id, public_key):
         """ Set public key given client id """
-        return self.execute(f"UPDATE {Database.CLIENTS} SET PublicKey = ? WHERE ID = ?", [client_id], True)
+        return self.execute(f"UPDATE {Database.CLIENTS} SET PublicKey = ? WHERE ID = ?", [public_key, client_id], True,
+                            self.shard(client_id))
 
-    def update_aes_key(self, client_id):
+    def update_aes_key(self, client_id, aes_key):
         """ Set aes key given client id"""
-        return self.execute(f"UPDATE {Database.CLIENTS} SET AESKey = ? WHERE ID = ?", [client_id], True)
+        return self.execute(f"UPDATE {Database.CLIENTS} SET AESKey = ? WHERE ID = ?", [aes_key, client_id], True,
+                            self.shard(client_id))
 
     def update_last_seen(self, client_id, time):
         """ Set LastSeen given client id """
-        return self.execute(f"UPDATE {Database.CLIENTS} SET LastSeen = ? WHERE ID = ?", [time, client_id], True)
+        return self.execute(f"UPDATE {Database.CLIENTS} SET LastSeen = ? WHERE ID = ?", [time, client_id], True,
+                            self.shard(client_id))
 
     def get_client_name(self, client_id):
         """ Get client_name given client id """
-        return self.execute(f"SELECT Name FROM {Database.CLIENTS} WHERE ID = ?", [client_id])
+        return self.execute(f"SELECT Name FROM {Database.CLIENTS} WHERE ID = ?", [client_id],
+                            name=self.shard(client_id))
 
     def get_aes_key(self, client_id):
-        """ Get aes_key given client id """
-        return self.execute(f"SELECT AESKey FROM {Database.CLIENTS} WHERE ID = ?", [client_id])
+        """ Get aes_key given client id, None if the client is unknown """
+        results = self.execute(f"SELECT AESKey FROM {Database.CLIENTS} WHERE ID = ?", [client_id],
+                               name=self.shard(client_id))
+        if not results:
+            return None
+        return results[0][0]
 
     def get_public_key(self, client_id):
-        """ Get public_key given client id """
-        return self.execute(f"SELECT PublicKey FROM {Database.CLIENTS} WHERE ID = ?", [client_id])
+        """ Get public_key given client id, None if the client is unknown """
+        results = self.execute(f"SELECT PublicKey FROM {Database.CLIENTS} WHERE ID = ?", [client_id],
+                               name=self.shard(client_id))
+        if not results:
+            return None
+        return results[0][0]
 
     def file_details(self, file):
-        """ Store file details  into database """
-        if not type(file) is File or not file.validate():
+        """ Store file details into database, replacing an earlier upload of the same file name """
+        if not type(file) is File or not file.validate_file():
             return False
         results = self.execute(
-            f"INSERT INTO {Database.FILES} VALUES (?, ?, ?, ?)", [file.ID, file.FileName, file.PathName, file.Verified], True)
+            f"INSERT OR REPLACE INTO {Database.FILES} (ID, FileName, PathName, Verified, Uploaded) "
+            f"VALUES (?, ?, ?, ?, ?)",
+            [file.ID, file.FileName, file.PathName, file.Verified, datetime.now()], True, self.shard(file.ID))
         return results
 
+    def get_stored_content(self, content_hash, size):
+        """ Get PathName and Cksum of already stored content given its hash and size """
+        results = self.execute(f"SELECT PathName, Cksum FROM {Database.CONTENTS} WHERE Hash = ? AND Size = ?",
+                               [content_hash, size], name=self.shard(content_hash))
+        if not results:
+            return None
+        return results[0]
+
+    def store_content(self, content_hash, size, path_name, cksum):
+        """ Index stored content by its hash; path_name is derived from the hash, so an entry never goes stale """
+        return self.execute(f"INSERT OR IGNORE INTO {Database.CONTENTS} VALUES (?, ?, ?, ?)",
+                            [content_hash, size, path_name, cksum], True, self.shard(content_hash))
+
+    def get_content_cksum(self, path_name):
+        """ Get the cksum recorded for stored content given its path name, looking in every shard """
+        for shard in self.shards:
+            results = self.execute(f"SELECT Cksum FROM {Database.CONTENTS} WHERE PathName = ?", [path_name],
+                                   name=shard)
+            if results:
+                return results[0][0]
+        return None
+
+    def update_verified_false(self, path_name):
+        """ Set Verified to false for every file stored at the given path name """
+        for shard in self.shards:
+            self.execute(f"UPDATE {Database.FILES} SET Verified = ? WHERE PathName = ?", [False, path_name], True,
+                         shard)
+        return True
+
+    def update_verified_true(self, client_id, file_name):
+        """ Set Verified to true given client id and file name """
+        return self.execute(f"UPDATE {Database.FILES} SET Verified = ? WHERE ID = ? AND FileName = ?",
+                            [True, client_id, file_name], True, self.shard(client_id))
+
+    def get_unverified_files(self, shard, uploaded_before, limit):
+        """ Get ID, FileName and PathName of up to limit unverified files uploaded before the given time """
+        return self.execute(f"SELECT ID, FileName, PathName FROM {Database.FILES} WHERE Verified = 0 AND Uploaded < ? "
+                            f"LIMIT ?", [uploaded_before, limit], name=shard)
+
+    def delete_files(self, shard, files):
+        """ Delete files entries given their (ID, FileName) keys """
+        placeholders = ", ".join("(?, ?)" for _ in files)
+        keys = [value for file_id, file_name in files for value in (file_id, file_name)]
+        return self.execute(f"DELETE FROM {Database.FILES} WHERE (ID, FileName) IN (VALUES {placeholders})", keys,
+                            True, shard)
+
+    def path_referenced(self, path_name):
+        """ Check whether any files entry, in any shard, still points at the given path name """
+        for shard in self.shards:
+            if self.execute(f"SELECT 1 FROM {Database.FILES} WHERE PathName = ? LIMIT 1", [path_name], name=shard):
+                return True
+        return False
+
+    def delete_content(self, path_name):
+        """ Remove the content index entries of the given path name """
+        for shard in self.shards:
+            self.execute(f"DELETE FROM {Database.CONTENTS} WHERE PathName = ?", [path_name], True, shard)
+        return True
+
+    def get_stale_clients(self, shard, last_seen_before, limit):
+        """ Get ID and Name of up to limit clients not seen since the given time """
+        return self.execute(f"SELECT ID, Name FROM {Database.CLIENTS} WHERE LastSeen < ? LIMIT ?",
+                            [last_seen_before, limit], name=shard)
+
+    def archive_clients(self, shard, clients, last_seen_before):
+        """ Move the given (ID, Name) clients that are still not seen since the given time to the archive table and
+        drop their names. Return the number of clients archived, None on failure """
+        ids = [client_id for client_id, _ in clients]
+        placeholders = ", ".join("?" * len(ids))
+        conn = self.connect(shard)
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")  # no client can come back between the check and the move
+                stale = conn.execute(f"SELECT ID, Name FROM {Database.CLIENTS} WHERE ID IN ({placeholders}) "
+                                     f"AND LastSeen < ?", ids + [last_seen_before]).fetchall()
+                ids = [client_id for client_id, _ in stale]
+                placeholders = ", ".join("?" * len(ids))
+                conn.execute(f"INSERT INTO {Database.CLIENTS_ARCHIVE} SELECT * FROM {Database.CLIENTS} "
+                             f"WHERE ID IN ({placeholders})", ids)
+                conn.execute(f"DELETE FROM {Database.CLIENTS} WHERE ID IN ({placeholders})", ids)
+        except Exception as e:
+            logging.exception('database archive clients: %s', e)
+            return None
+        finally:
+            conn.close()
+        if not stale:
+            return 0
+        names = [name.decode('utf-8') if isinstance(name, bytes) else name for _, name in stale]
+        if not self.execute(f"DELETE FROM {Database.NAMES} WHERE Name IN ({placeholders})", names, True):
+            return None
+        return len(stale)
+
+    def incremental_vacuum(self, shard, pages):
+        """ Give up to pages free pages of the shard back to the file system """
+        return self.execute_script(f"PRAGMA incremental_vacuum({int(pages)});", shard)
 
-    def update_verified_true(self, client_id):
-        """ Set Verified to true given client id """
-        return self.execute(f"UPDATE {Database.CLIENTS} SET Verified = ? WHERE ID = ?", [True, client_id], True)
     #
     # def removeMessage(self, msg_id):
     #     """ remove a message by id from database """
@@ -0,0 +1,128 @@
+"""
+Durability modes for stored files and database commits, picked with Config.durability:
+
+none     No fsync, SQLite synchronous=OFF. Fastest. A power loss or OS crash can lose acknowledged uploads and
+         metadata, and may corrupt the database. A process crash alone loses nothing already written.
+batched  Files are fsynced, and the database (WAL journal, synchronous=NORMAL) checkpointed, every
+         Config.durability_flush_interval seconds by a background thread. A power loss can lose at most the
+         last interval of acknowledged work; the database stays consistent.
+strict   Each file and its directory are fsynced before file_received_ok_with_crc is sent, and every commit is
+         synced (rollback journal, synchronous=FULL). An acknowledged upload survives a power loss. The default:
+         the database keeps SQLite's own commit guarantees, as before the modes existed.
+
+benchmark.py --group durability measures the cost of each mode.
+"""
+import logging
+import os
+import threading
+import time
+
+import config
+
+config = config.get()
+
+NONE = "none"
+BATCHED = "batched"
+STRICT = "strict"
+
+# per connection settings
+PRAGMAS = {
+    NONE: {"synchronous": "OFF"},
+    BATCHED: {"synchronous": "NORMAL"},
+    STRICT: {"synchronous": "FULL"},
+}
+# settings stored in the database file, applied once when it is initialized
+JOURNAL_MODES = {
+    NONE: "DELETE",
+    BATCHED: "WAL",
+    STRICT: "DELETE",
+}
+
+
+def fsync_directory(path):
+    """ Make a file's directory entry durable; not possible (nor needed) on every platform """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def written(f, path):
+    """ Called with a just written, still open file; makes it durable as the configured mode requires """
+    if config.durability == STRICT:
+        f.flush()
+        os.fsync(f.fileno())
+        fsync_directory(path)
+    elif config.durability == BATCHED:
+        flusher.add(path)
+
+
+class Flusher:
+    """ Background fsync of recently written files and checkpoint of the database, for batched mode """
+
+    def __init__(self):
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.db = None
+        self.connections = []
+
+    def add(self, path):
+        with self.lock:
+            self.pending.add(path)
+
+    def flush(self):
+        """ Make everything written so far durable """
+        with self.lock:
+            paths, self.pending = self.pending, set()
+        directories = set()
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+                directories.add(os.path.dirname(os.path.abspath(path)))
+            except OSError as e:
+                logging.error("Durability: Failed to fsync %s due to: %s", path, e)
+        for directory in directories:
+            fsync_directory(os.path.join(directory, ""))
+        if self.db is not None:
+            for shard in self.db.shards:
+                self.db.execute("PRAGMA wal_checkpoint(PASSIVE)", [], name=shard)
+        return len(paths)
+
+    def run(self):
+        while True:
+            time.sleep(config.durability_flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception("Durability flusher exception: %s", e)
+
+    def attach(self, db):
+        """ Checkpoint db on flush. In batched mode also keep a connection to each shard open: otherwise every
+        per-query connection, being the last one to close, would checkpoint and remove the WAL on its own. """
+        self.detach()
+        self.db = db
+        if config.durability == BATCHED:
+            self.connections = [db.connect(shard) for shard in db.shards]
+
+    def detach(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+        self.db = None
+
+    def start(self, db):
+        """ Flush periodically in a background daemon thread; only needed in batched mode """
+        self.attach(db)
+        if config.durability != BATCHED:
+            return None
+        worker = threading.Thread(target=self.run, name="durability-flusher", daemon=True)
+        worker.start()
+        return worker
+
+
+flusher = Flusher()
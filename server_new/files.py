@@ -1,6 +1,6 @@
 import config
 
-config = config.Config()
+config = config.get()
 
 
 class File:
@@ -18,7 +18,7 @@ class File:
             return False
         if not self.FileName or len(self.FileName) >= config.file_name_size:
             return False
-        if not self.PathName or len(self.PathName) != config.path_name_size:
+        if not self.PathName or len(self.PathName) >= config.path_name_size:
             return False
         if not isinstance(self.Verified, bool):
             return False
@@ -6,6 +6,10 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 import io
 
+from cksum import memcrc
+import durability
+import tracing
+
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 
@@ -33,36 +37,56 @@ def generate_aes_key():
     return key
 
 
-def encrypt_aes_key(aes_key, public_key_str):
-    # Load the public key from a string
-    public_key = serialization.load_pem_public_key(
-        public_key_str.encode(),
-        backend=default_backend()
-    )
-
-    # Encrypt the AES key with the public key
-    encrypted_aes_key = public_key.encrypt(
-        aes_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
+def encrypt_aes_key(aes_key, public_key):
+    with tracing.span("crypto.rsa_encrypt"):
+        # Load the public key: DER bytes as sent by clients, or a PEM string
+        if isinstance(public_key, str):
+            public_key = serialization.load_pem_public_key(public_key.encode(), backend=default_backend())
+        else:
+            public_key = serialization.load_der_public_key(bytes(public_key), backend=default_backend())
+
+        # Encrypt the AES key with the public key
+        encrypted_aes_key = public_key.encrypt(
+            aes_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
         )
-    )
 
     return encrypted_aes_key
 
 
 def decrypt_file_content(encrypted_content, aes_key):
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(b'\0' * 16), backend=default_backend())
-    decryptor = cipher.decryptor()
-    decrypted_content = decryptor.update(encrypted_content) + decryptor.finalize()
+    with tracing.span("crypto.aes_decrypt", size=len(encrypted_content)):
+        cipher = Cipher(algorithms.AES(aes_key), modes.CFB(b'\0' * 16), backend=default_backend())
+        decryptor = cipher.decryptor()
+        decrypted_content = decryptor.update(encrypted_content) + decryptor.finalize()
     return decrypted_content
 
 
+def cksum(content):
+    """ Calculate the POSIX cksum of the given content. """
+    with tracing.span("cksum", size=len(content)):
+        return memcrc(content)
+
+
+def content_hash(content):
+    """ Calculate the SHA-256 digest used to index stored file contents. """
+    with tracing.span("content_hash", size=len(content)):
+        return hashlib.sha256(content).digest()
+
+
+def stored_path(file_name):
+    """ Path a file of the given name is saved at. """
+    return f'/tmp/{file_name}'
+
+
 def save_to_ram(file_content, file_name):
     in_memory_file = io.BytesIO(file_content)
-    file_path = f'/tmp/{file_name}'
-    with open(file_path, 'wb') as f:
+    file_path = stored_path(file_name)
+    with tracing.span("disk.write", size=len(file_content)), open(file_path, 'wb') as f:
         f.write(in_memory_file.read())
+        durability.written(f, file_path)
     return file_path
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+import config
+
+config = config.get()
+
+FORMAT = '[%(levelname)s - %(asctime)s]: %(message)s'
+FIELDS = ("category", "code", "client_id", "duration_ms", "success")
+
+context = threading.local()
+
+
+def sample(category):
+    """ Decide whether success logs of the given category are kept. """
+    rate = config.log_sample_rates.get(category, config.log_sample_rate)
+    return rate >= 1 or random.random() < rate
+
+
+class RequestContext:
+    """ Attach request fields to every record logged while handling a request, and sample its success logs. """
+
+    def __init__(self, category, code, client_id):
+        self.category = category
+        self.code = code
+        self.client_id = client_id.hex() if isinstance(client_id, bytes) else client_id
+        self.sampled = sample(category)
+        self.start = None
+
+    def elapsed_ms(self):
+        return round((time.monotonic() - self.start) * 1000, 3)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        context.request = self
+        return self
+
+    def __exit__(self, *exc):
+        context.request = None
+        return False
+
+
+class ContextFilter(logging.Filter):
+    """ Add request fields to records, drop unsampled success logs; warnings and errors are always kept. """
+
+    def filter(self, record):
+        request = getattr(context, 'request', None)
+        if request is not None:
+            for field in ("category", "code", "client_id"):
+                if not hasattr(record, field):
+                    setattr(record, field, getattr(request, field))
+            sampled = request.sampled
+        elif hasattr(record, "category"):
+            sampled = sample(record.category)
+        else:
+            sampled = True
+        return sampled or record.levelno >= logging.WARNING
+
+
+class StructuredFormatter(logging.Formatter):
+    """ Format the message, followed by the structured fields the record carries as key=value pairs. """
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [f"{field}={getattr(record, field)}" for field in FIELDS if hasattr(record, field)]
+        if fields:
+            text = f"{text} | {' '.join(fields)}"
+        return text
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ Queue records with only their message merged; the listener thread does the rest of the formatting. """
+
+    def prepare(self, record):
+        # args may be mutable (a connection, a buffer) and change once the handling thread moves on
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            # tracebacks can't wait: the frames may change once the handling thread moves on
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(level=logging.INFO):
+    """ Route all logging through a queue to a background writer thread. Return the started listener. """
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    stream = logging.StreamHandler()
+    stream.setFormatter(StructuredFormatter(FORMAT, datefmt='%H:%M:%S'))
+    listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
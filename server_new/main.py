@@ -1,10 +1,22 @@
+import signal
+
 import helpers
+import logs
 import server
+import tracing
 import config
 
-config = config.Config()
+config = config.get()
 
 if __name__ == '__main__':
+    try:
+        config.load()
+    except ValueError as e:
+        helpers.stop_server(e)
+    logs.setup()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: config.reload())
+    tracing.setup()
     port_info = "server_new/port.info"
     port = helpers.parse_port(port_info)
     if port is None:
@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import config
+
+config = config.get()
+
+
+class Maintenance:
+    """ Background retention job: removes unverified uploads, archives long-idle clients and vacuums shards.
+    Work is done in small batches with pauses in between so foreground requests keep the database. """
+
+    def __init__(self, db):
+        self.db = db
+        self.stopped = threading.Event()
+
+    def pause(self):
+        """ Rate limit between batches, return False once stopped """
+        return not self.stopped.wait(config.maintenance_batch_pause)
+
+    def remove_unverified_files(self):
+        """ Delete files that stayed unverified longer than the retention, with their stored content """
+        cutoff = datetime.now() - timedelta(hours=config.unverified_file_retention_hours)
+        removed = 0
+        for shard in self.db.shards:
+            while True:
+                rows = self.db.get_unverified_files(shard, cutoff, config.maintenance_batch_size)
+                if not rows:
+                    break
+                keys = [(file_id, file_name.decode('utf-8')) for file_id, file_name, _ in rows]
+                if not self.db.delete_files(shard, keys):
+                    logging.error("Maintenance: Failed to delete unverified files of %s.", shard)
+                    break
+                for _, _, path_name in rows:
+                    path_name = path_name.decode('utf-8') if isinstance(path_name, bytes) else path_name
+                    # uploads hold the lock while saving or referencing the content
+                    with self.db.content_lock(path_name):
+                        if self.db.path_referenced(path_name):
+                            continue  # the content is shared with another files entry
+                        self.db.delete_content(path_name)
+                        try:
+                            os.remove(path_name)
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logging.error("Maintenance: Failed to remove %s due to: %s", path_name, e)
+                removed += len(rows)
+                if len(rows) < config.maintenance_batch_size or not self.pause():
+                    break
+        return removed
+
+    def archive_stale_clients(self):
+        """ Move clients not seen for longer than the threshold to the archive table """
+        cutoff = str(datetime.now() - timedelta(days=config.client_archive_after_days))
+        archived = 0
+        for shard in self.db.shards:
+            while True:
+                rows = self.db.get_stale_clients(shard, cutoff, config.maintenance_batch_size)
+                if not rows:
+                    break
+                count = self.db.archive_clients(shard, rows, cutoff)
+                if count is None:
+                    break
+                archived += count
+                if len(rows) < config.maintenance_batch_size or not self.pause():
+                    break
+        return archived
+
+    def vacuum(self):
+        """ Reclaim a bounded number of free pages per shard """
+        for shard in self.db.shards:
+            self.db.incremental_vacuum(shard, config.maintenance_vacuum_pages)
+            if not self.pause():
+                break
+
+    def run_once(self):
+        """ Run every retention policy once """
+        start = time.monotonic()
+        removed = self.remove_unverified_files()
+        archived = self.archive_stale_clients()
+        self.vacuum()
+        logging.info("Maintenance: removed %s unverified files, archived %s clients in %.1fs.",
+                     removed, archived, time.monotonic() - start, extra={"category": "maintenance"})
+
+    def run(self):
+        """ Run the retention policies every interval until stopped """
+        while not self.stopped.wait(config.maintenance_interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.exception("Maintenance exception: %s", e)
+
+    def start(self):
+        """ Run maintenance in a background daemon thread """
+        worker = threading.Thread(target=self.run, name="maintenance", daemon=True)
+        worker.start()
+        return worker
+
+    def stop(self):
+        self.stopped.set()
@@ -1,6 +1,6 @@
 import config
 from helpers import cksum
-config = config.Config()
+config = config.get()
 
 
 class Message:
@@ -0,0 +1,356 @@
+"""
+Network condition simulation: runs scripted client scenarios against the server through a local TCP proxy
+that adds latency, jitter, bandwidth limits and connection resets.
+
+Run from the repository root, e.g.:
+    python server_new/netsim.py --scenario upload --latency 80 --jitter 20 --bandwidth 256 --reset-rate 0.05
+By default a server is started on a temporary database; use --server HOST:PORT to test a running one.
+Exits with 1 when any client fails to complete the scenario.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import queue
+import random
+import secrets
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+import cksum
+import config
+
+config = config.get()
+
+CHUNK_SIZE = 16 * 1024
+
+
+class Conditions:
+    """ Link conditions applied to each direction of a proxied connection """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, reset_rate=0.0, reset_after=64 * 1024):
+        self.latency = latency  # one way delay, seconds.
+        self.jitter = jitter  # random extra delay of up to +/- jitter seconds.
+        self.bandwidth = bandwidth  # bytes per second, None for unlimited.
+        self.reset_rate = reset_rate  # probability that a connection gets reset.
+        self.reset_after = reset_after  # a reset connection is reset within this many forwarded bytes.
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+class Proxy:
+    """ Local TCP proxy forwarding to the server under the given conditions """
+
+    def __init__(self, upstream, conditions):
+        self.upstream = upstream
+        self.conditions = conditions
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.address = self.sock.getsockname()
+        self.lock = threading.Lock()
+        self.forwarded = 0
+        self.resets = 0
+        self.connections = 0
+
+    def start(self):
+        threading.Thread(target=self.accept, name="netsim-proxy", daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.proxy, args=(client,), daemon=True).start()
+
+    def proxy(self, client):
+        try:
+            server = socket.create_connection(self.upstream)
+        except OSError:
+            client.close()
+            return
+        budget = None
+        if random.random() < self.conditions.reset_rate:
+            budget = random.randint(1, self.conditions.reset_after)  # bytes forwarded before the reset
+        state = {"budget": budget, "closed": False}
+        with self.lock:
+            self.connections += 1
+        for src, dst in ((client, server), (server, client)):
+            pending = queue.Queue()
+            threading.Thread(target=self.receive, args=(src, pending, state, client, server), daemon=True).start()
+            threading.Thread(target=self.deliver, args=(dst, pending, state), daemon=True).start()
+
+    def receive(self, src, pending, state, client, server):
+        """ Read from src and queue each chunk for delivery after the link delay """
+        last_due = 0.0
+        while True:
+            try:
+                data = src.recv(CHUNK_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                pending.put((time.monotonic() + self.conditions.delay(), None))
+                return
+            with self.lock:
+                if state["budget"] is not None:
+                    state["budget"] -= len(data)
+                    if state["budget"] <= 0:
+                        self.resets += 1
+                        self.reset(client, server, state)
+                        return
+            last_due = max(last_due, time.monotonic() + self.conditions.delay())  # keep the byte order
+            pending.put((last_due, data))
+
+    def deliver(self, dst, pending, state):
+        """ Send queued chunks once due, paced to the bandwidth limit """
+        sent_until = 0.0
+        while True:
+            due, data = pending.get()
+            if data is not None and self.conditions.bandwidth:
+                sent_until = max(sent_until, due) + len(data) / self.conditions.bandwidth
+                due = sent_until
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if state["closed"]:
+                return
+            try:
+                if data is None:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except OSError:
+                return
+            with self.lock:
+                self.forwarded += len(data)
+
+    @staticmethod
+    def reset(client, server, state):
+        """ Abort both sides with a TCP reset """
+        state["closed"] = True
+        for sock in (client, server):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                sock.shutdown(socket.SHUT_RD)  # wake a thread blocked reading it, else close won't reset
+                sock.close()
+            except OSError:
+                pass
+
+    def stop(self):
+        self.sock.close()
+
+
+class SimClient:
+    """ Minimal protocol client; every request uses its own connection, like the real client """
+
+    def __init__(self, address, name, retries=5):
+        self.address = address
+        self.name = name
+        self.client_id = bytes(config.client_id_size)  # assigned by the server on registration
+        # e=3 keeps the DER encoded key at the protocol's 160 bytes, like the real client's key
+        self.private_key = rsa.generate_private_key(public_exponent=3, key_size=1024)
+        self.aes_key = None
+        self.retries = retries
+        self.requests = 0
+        self.sent = 0
+        self.retransmitted = 0
+        self.codes = {}
+
+    def packet(self, code, payload):
+        data = self.client_id + struct.pack("<BHL", config.server_version, code, len(payload)) + payload
+        if len(data) < config.packet_size:
+            data += bytes(config.packet_size - len(data))  # padded like the server pads its responses
+        return data
+
+    def request(self, code, payload):
+        """ Send one request and return the response (code, payload), retrying on connection failures """
+        data = self.packet(code, payload)
+        for attempt in range(self.retries + 1):
+            self.requests += 1
+            self.sent += len(data)
+            try:
+                with socket.create_connection(self.address) as conn:
+                    conn.sendall(data)
+                    response = b""
+                    while len(response) < config.packet_size:
+                        chunk = conn.recv(config.packet_size - len(response))
+                        if not chunk:
+                            break
+                        response += chunk
+                if len(response) < config.header_size:
+                    raise ConnectionError("connection closed before a response")
+                _, response_code, payload_size = struct.unpack("<BHL", response[:config.header_size])
+                self.codes[response_code] = self.codes.get(response_code, 0) + 1
+                return response_code, response[config.header_size:config.header_size + payload_size]
+            except OSError:
+                self.retransmitted += len(data)
+        return None, b""
+
+    def name_field(self):
+        return self.name.encode().ljust(config.name_size, b"\0")
+
+    def receive_aes_key(self, payload):
+        """ Decrypt the aes key following the client id in a key exchange or reconnection response """
+        try:
+            self.aes_key = self.private_key.decrypt(payload[config.client_id_size:], padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))
+        except ValueError:
+            return False
+        return True
+
+    def register(self):
+        code, payload = self.request(config.registration_request, self.name_field())
+        if code != config.successful_registration:
+            return False
+        self.client_id = payload[:config.client_id_size]
+        return True
+
+    def send_public_key(self):
+        public_key = self.private_key.public_key().public_bytes(serialization.Encoding.DER,
+                                                                serialization.PublicFormat.SubjectPublicKeyInfo)
+        code, payload = self.request(config.sending_public_key, self.name_field() + public_key)
+        return code == config.exchanging_keys and self.receive_aes_key(payload)
+
+    def reconnect(self):
+        code, payload = self.request(config.reconnection_request, self.name_field())
+        return code == config.confirm_reconnect_request_send_aes_encrypted and self.receive_aes_key(payload)
+
+    def upload(self, content, file_name):
+        """ Hash check first; transfer the file only if the server doesn't hold its content yet. Succeeds when the
+        server reports the content's cksum """
+        name = file_name.encode().ljust(config.file_name_size, b"\0")
+        code, payload = self.request(config.file_hash_check,
+                                     struct.pack("<L", len(content)) + name + hashlib.sha256(content).digest())
+        if code == config.file_content_unknown:
+            encryptor = Cipher(algorithms.AES(self.aes_key), modes.CFB(b"\0" * 16)).encryptor()
+            encrypted = encryptor.update(content) + encryptor.finalize()
+            code, payload = self.request(config.sending_file, struct.pack("<L", len(encrypted)) + name + encrypted)
+        if code != config.file_received_ok_with_crc:
+            return False
+        offset = config.client_id_size + config.content_size
+        return struct.unpack("<L", payload[offset:offset + config.cksum_size])[0] == cksum.memcrc(content)
+
+    def valid_crc(self, file_name):
+        code, _ = self.request(config.valid_crc, file_name.encode().ljust(config.file_name_size, b"\0"))
+        return code == config.confirm_crc_msg_received
+
+
+# name -> (untimed setup, timed steps); each returns whether every request got its expected response
+SCENARIOS = {
+    # first contact: register, exchange keys, upload a file and confirm its crc
+    "upload": (None, lambda client, content, file_name: client.register() and client.send_public_key() and
+               client.upload(content, file_name) and client.valid_crc(file_name)),
+    # returning client: reconnect, upload a file and confirm its crc
+    "reconnect": (lambda client: client.register() and client.send_public_key(),
+                  lambda client, content, file_name: client.reconnect() and client.upload(content, file_name) and
+                  client.valid_crc(file_name)),
+}
+
+
+def run_scenario(address, scenario, clients, file_size, seed):
+    """ Run scenario concurrently for clients clients, return (duration per client, None if it failed, clients) """
+    rng = random.Random(seed)
+    content = rng.randbytes(file_size)
+    sims = [SimClient(address, f"netsim{os.getpid()}x{i}") for i in range(clients)]
+    durations = [None] * clients
+    setup, steps = SCENARIOS[scenario]
+
+    def run(index):
+        if setup is not None and not setup(sims[index]):
+            return
+        start = time.monotonic()
+        if steps(sims[index], content, f"netsim-{os.getpid()}-{index}.bin"):
+            durations[index] = time.monotonic() - start
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations, sims
+
+
+def start_server(directory):
+    """ Start a server on a free local port with its database in directory, return its address """
+    import server
+    config.database = os.path.join(directory, "netsim.db")
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    svr = server.Server('127.0.0.1', port)
+    threading.Thread(target=svr.start, name="netsim-server", daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return '127.0.0.1', port
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run client scenarios through a simulated network.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="upload")
+    parser.add_argument("--clients", type=int, default=1, help="concurrent clients")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="uploaded file size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="one way latency, ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency jitter, +/- ms")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bandwidth cap per direction, KB/s")
+    parser.add_argument("--reset-rate", type=float, default=0.0, help="probability of resetting a connection")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the simulated network and content")
+    parser.add_argument("--server", help="HOST:PORT of a running server instead of starting one")
+    parser.add_argument("--verbose", action="store_true", help="show the server's log")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)  # the report below is the output
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.server:
+            host, port = args.server.rsplit(":", 1)
+            upstream = (host, int(port))
+        else:
+            upstream = start_server(directory)
+        conditions = Conditions(args.latency / 1000, args.jitter / 1000,
+                                args.bandwidth * 1024 if args.bandwidth else None, args.reset_rate)
+        proxy = Proxy(upstream, conditions)
+        proxy.start()
+        durations, sims = run_scenario(proxy.address, args.scenario, args.clients, args.file_size, args.seed)
+        proxy.stop()
+
+    finished = [duration for duration in durations if duration is not None]
+    codes = {}
+    for sim in sims:
+        for code, count in sim.codes.items():
+            codes[code] = codes.get(code, 0) + count
+    print(f"scenario            {args.scenario} x {args.clients} client(s), {args.file_size} byte file")
+    print(f"conditions          latency {args.latency} ms +/- {args.jitter} ms, "
+          f"bandwidth {args.bandwidth or 'unlimited'} KB/s, reset rate {args.reset_rate}")
+    print(f"completed           {len(finished)} of {args.clients} client(s)")
+    if finished:
+        print(f"completion time     mean {sum(finished) / len(finished):.3f} s, max {max(finished):.3f} s "
+              f"(completed clients only)")
+    else:
+        print("completion time     n/a, no client completed the scenario")
+    print(f"requests            {sum(sim.requests for sim in sims)} over {proxy.connections} connection(s)")
+    print(f"bytes sent          {sum(sim.sent for sim in sims)}")
+    print(f"retransmitted bytes {sum(sim.retransmitted for sim in sims)}")
+    print(f"proxy               {proxy.forwarded} bytes forwarded, {proxy.resets} reset(s)")
+    print(f"response codes      {dict(sorted(codes.items()))}")
+    return 0 if len(finished) == args.clients else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,9 @@
 import struct
+import time
 import config
 import logging
 
-config = config.Config()
-logging.basicConfig(format='[%(levelname)s - %(asctime)s]: %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+config = config.get()
 
 
 class RequestHeader:
@@ -21,7 +21,7 @@ class RequestHeader:
             self.version, self.code, self.payload_size = struct.unpack("<BHL", header_data)
             return True
         except Exception as e:
-            logging.error(f"Unpacking request header failed due to: {e}")
+            logging.error("Unpacking request header failed due to: %s", e)
             self.__init__()  # reset values
             return False
 
@@ -103,7 +103,7 @@ class SendingPublicKeyResponse:
         try:
             data = self.header.pack()
             data += struct.pack(f"<{config.client_id_size}s", self.clientID)
-            data += struct.pack(f"<{config.aes_key_size}s", self.aes_key)
+            data += struct.pack(f"<{len(self.aes_key)}s", self.aes_key)  # encrypted, as long as the client's key
             return data
         except:
             return b""
@@ -136,7 +136,7 @@ class ReconnectionResponse:
         try:
             data = self.header.pack()
             data += struct.pack(f"<{config.client_id_size}s", self.clientID)
-            data += struct.pack(f"<{config.aes_key_size}s", self.aes_key)
+            data += struct.pack(f"<{len(self.aes_key)}s", self.aes_key)  # encrypted, as long as the client's key
             return data
         except:
             return b""
@@ -150,30 +150,41 @@ class SendingFileRequest:
         self.message_content = b""
 
     def unpack(self, conn, data):
-        # TODO: double check this code
         packet_size = len(data)
         if not self.header.unpack(data):
             return False
         try:
             content_size = data[self.header.size:self.header.size + config.content_size]
-            self.content_size = struct.unpack(f"<{config.content_size}s", content_size)[0]
+            self.content_size = struct.unpack("<L", content_size)[0]
             file_name = data[self.header.size + config.content_size:self.header.size + config.content_size +
                                                                config.file_name_size]
-            self.file_name = struct.unpack(f"<{config.file_name_size}s", file_name)[0]
+            self.file_name = str(struct.unpack(f"<{config.file_name_size}s", file_name)[0].partition(b'\0')[0].
+                                 decode('utf-8'))
             offset = self.header.size + config.content_size + config.file_name_size
             bytes_to_read = packet_size - offset
             if bytes_to_read > self.content_size:
                 bytes_to_read = self.content_size
-            self.message_content = struct.unpack(f"<{bytes_to_read}s", data[offset:offset + bytes_to_read])[0]
+            if self.content_size > self.header.payload_size:
+                raise ValueError(f"content size {self.content_size} exceeds payload size {self.header.payload_size}")
+            # receive the rest of the content straight into one preallocated buffer
+            self.message_content = bytearray(self.content_size)
+            content = memoryview(self.message_content)
+            content[:bytes_to_read] = data[offset:offset + bytes_to_read]
+            conn.settimeout(config.payload_timeout)
+            start = time.monotonic()
             while bytes_to_read < self.content_size:
-                data = conn.recv(packet_size),
-                data_size = len(data)
-                if (self.content_size - bytes_to_read) < data_size:
-                    data_size = self.content_size - bytes_to_read
-                self.content_size += struct.unpack(f"<{data_size}s", data[:data_size])[0]
+                data_size = conn.recv_into(content[bytes_to_read:])
+                if not data_size:
+                    raise ConnectionError(f"connection closed after {bytes_to_read} of {self.content_size} bytes")
                 bytes_to_read += data_size
+                if self.content_size >= config.min_rate_check_size:
+                    elapsed = time.monotonic() - start
+                    if elapsed > config.min_rate_grace and bytes_to_read / elapsed < config.min_transfer_rate:
+                        raise TimeoutError(f"transfer rate {bytes_to_read / elapsed:.0f} B/s is below minimum")
+            content.release()
             return True
-        except:
+        except Exception as e:
+            logging.error("Unpacking sending file request failed due to: %s", e)
             self.content_size = config.def_val
             self.file_name = b""
             self.message_content = b""
@@ -192,8 +203,8 @@ class SendingFileResponse:
         try:
             data = self.header.pack()
             data += struct.pack(f"<{config.client_id_size}s", self.clientID)
-            data += struct.pack(f"<{config.content_size}s", self.content_size)
-            data += struct.pack(f"<{config.cksum_size}s", self.cksum)
+            data += struct.pack("<L", self.content_size)
+            data += struct.pack("<L", self.cksum)
             return data
         except:
             return b""
@@ -247,3 +258,45 @@ class InvalidCRCRequest:
         except:
             self.file_name = b""
             return False
+
+
+class FileHashCheckRequest:
+    def __init__(self):
+        self.header = RequestHeader()
+        self.content_size = config.def_val
+        self.file_name = b""
+        self.content_hash = b""
+
+    def unpack(self, data):
+        if not self.header.unpack(data):
+            return False
+        try:
+            offset = self.header.size
+            self.content_size = struct.unpack("<L", data[offset:offset + config.content_size])[0]
+            offset += config.content_size
+            file_name_data = data[offset:offset + config.file_name_size]
+            self.file_name = str(struct.unpack(f"<{config.file_name_size}s", file_name_data)[0].partition(b'\0')[0].
+                                 decode('utf-8'))
+            offset += config.file_name_size
+            content_hash_data = data[offset:offset + config.content_hash_size]
+            self.content_hash = struct.unpack(f"<{config.content_hash_size}s", content_hash_data)[0]
+            return True
+        except:
+            self.content_size = config.def_val
+            self.file_name = b""
+            self.content_hash = b""
+            return False
+
+
+class FileContentUnknownResponse:
+    def __init__(self):
+        self.header = ResponseHeader(config.file_content_unknown)
+        self.clientID = b""
+
+    def pack(self):
+        try:
+            data = self.header.pack()
+            data += struct.pack(f"<{config.client_id_size}s", self.clientID)
+            return data
+        except:
+            return b""
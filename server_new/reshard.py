@@ -0,0 +1,83 @@
+"""
+Offline tool copying a client/file database into a new shard layout.
+
+Stop the server first, run e.g.
+    python reshard.py defensive.db 1 defensive_new.db 4
+then point the server at the new database (and set Config.db_shards to 4).
+"""
+import argparse
+import logging
+import os
+
+import database
+
+logging.basicConfig(format='[%(levelname)s - %(asctime)s]: %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+
+# table -> column used to pick the destination shard
+TABLES = {
+    database.Database.CLIENTS: 'ID',
+    database.Database.CLIENTS_ARCHIVE: 'ID',
+    database.Database.FILES: 'ID',
+    database.Database.CONTENTS: 'Hash',
+}
+
+
+def reshard(source, target):
+    """ Copy every row of source into target, routing each row by its key. Return number of copied rows. """
+    target.initialize()
+    copied = 0
+    for shard in source.shards:
+        if not os.path.exists(shard):
+            logging.warning("Skipping missing shard %s.", shard)
+            continue
+        src = source.connect(shard)
+        src.text_factory = str  # keep text columns text, they are compared with text (e.g. the files key)
+        try:
+            tables = src.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            existing = [row[0] for row in tables]
+            for table, key in TABLES.items():
+                if table not in existing:
+                    continue
+                cur = src.execute(f"SELECT * FROM {table}")
+                columns = [column[0] for column in cur.description]
+                key_index = columns.index(key)
+                placeholders = ", ".join("?" * len(columns))
+                column_names = ", ".join(columns)
+                conns = {}
+                for row in cur:
+                    name = target.shard(row[key_index])
+                    if name not in conns:
+                        conns[name] = target.connect(name)
+                    conns[name].execute(f"INSERT OR IGNORE INTO {table} ({column_names}) VALUES ({placeholders})", row)
+                    if table == database.Database.CLIENTS:
+                        if target.name not in conns:
+                            conns[target.name] = target.connect(target.name)
+                        conns[target.name].execute(f"INSERT OR IGNORE INTO {database.Database.NAMES} VALUES (?, ?)",
+                                                   [row[columns.index('Name')], row[key_index]])
+                    copied += 1
+                for conn in conns.values():
+                    conn.commit()
+                    conn.close()
+                logging.info("Copied %s from %s.", table, shard)
+        finally:
+            src.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy a database into a new shard layout (server must be stopped).")
+    parser.add_argument("source", help="source database name, e.g. defensive.db")
+    parser.add_argument("source_shards", type=int, help="shard count of the source database")
+    parser.add_argument("target", help="target database name, must differ from source")
+    parser.add_argument("target_shards", type=int, help="shard count of the target database")
+    args = parser.parse_args()
+    if os.path.abspath(args.source) == os.path.abspath(args.target):
+        parser.error("target must differ from source")
+    source = database.Database(args.source, args.source_shards)
+    target = database.Database(args.target, args.target_shards)
+    copied = reshard(source, target)
+    logging.info("Resharding done, %s rows copied into %s shard(s).", copied, len(target.shards))
+
+
+if __name__ == '__main__':
+    main()
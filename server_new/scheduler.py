@@ -0,0 +1,84 @@
+import collections
+import logging
+import threading
+from concurrent.futures import Future
+
+import config
+
+config = config.get()
+
+
+class Lane:
+    """ A bounded pool of worker threads, serving clients' pending requests round-robin. """
+
+    def __init__(self, name, workers, max_pending=None):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.queues = collections.OrderedDict()  # client id -> deque of (future, fn, args)
+        self.condition = threading.Condition()
+
+    def submit(self, client_id, fn, *args):
+        """ Queue fn(*args) for client_id, return a Future or None when the lane is full. """
+        future = Future()
+        with self.condition:
+            if self.max_pending is not None and self.pending >= self.max_pending:
+                logging.warning("%s lane is full, rejecting request.", self.name)
+                return None
+            self.queues.setdefault(client_id, collections.deque()).append((future, fn, args))
+            self.pending += 1
+            self.condition.notify()
+        return future
+
+    def next_task(self):
+        """ Take the oldest request of the next client in turn. """
+        with self.condition:
+            while not self.queues:
+                self.condition.wait()
+            client_id, queue = self.queues.popitem(last=False)
+            task = queue.popleft()
+            if queue:
+                self.queues[client_id] = queue  # move client to the back of the rotation
+            self.pending -= 1
+            return task
+
+    def work(self):
+        """ Worker loop: run queued requests forever. """
+        while True:
+            future, fn, args = self.next_task()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                logging.exception("%s lane worker exception: %s", self.name, e)
+                future.set_exception(e)
+
+    def start(self):
+        """ Start the lane's worker threads. """
+        for i in range(self.workers):
+            threading.Thread(target=self.work, name=f"{self.name}-{i}", daemon=True).start()
+
+
+class Scheduler:
+    """ Route control requests to a reserved fast lane and file transfers to a bounded bulk lane. """
+    BULK_CODES = (config.sending_file,)
+
+    def __init__(self):
+        self.control = Lane("control", config.control_workers)
+        self.bulk = Lane("bulk", config.bulk_workers, config.bulk_queue_size)
+
+    def start(self):
+        self.control.start()
+        self.bulk.start()
+
+    def classify(self, header):
+        """ Pick a lane given the parsed request header. """
+        if header.code in Scheduler.BULK_CODES or header.payload_size >= config.bulk_payload_threshold:
+            return self.bulk
+        return self.control
+
+    def submit(self, header, fn, *args):
+        """ Queue fn(*args) in the lane matching header, return a Future or None when rejected. """
+        return self.classify(header).submit(header.clientID, fn, *args)
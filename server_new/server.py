@@ -1,28 +1,35 @@
 import logging
+import os
 import threading
 import socket
 import uuid
 
+import buffers
+import connections
 import database
+import durability
 import helpers
+import logs
+import maintenance
 import protocol
+import scheduler
+import tracing
 from datetime import datetime
 import config
 
-config = config.Config()
-
-logging.basicConfig(format='[%(levelname)s - %(asctime)s]: %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+config = config.get()
 
 
 class Server:
-    DATABASE = 'defensive.db'
-    PACKET_SIZE = 1024
-
     def __init__(self, host, port):
         """ Initializing server """
         self.host = host
         self.port = port
-        self.database = database.Database(Server.DATABASE)
+        self.database = database.Database(config.database)
+        self.reaper = connections.ConnectionReaper()
+        self.scheduler = scheduler.Scheduler()
+        self.buffers = buffers.BufferPool(config.packet_size)
+        self.maintenance = maintenance.Maintenance(self.database)
         self.request_handle = {
             config.registration_request: self.handle_registration_request,
             config.sending_public_key: self.sending_public_key,
@@ -30,55 +37,127 @@ class Server:
             config.sending_file: self.sending_file,
             config.valid_crc: self.sending_valid_crc_request,
             config.non_valid_crc: self.invalid_crc_resending_request,
-            config.non_valid_crc_fourth_time: self.invalid_crc_resending_last_time
+            config.non_valid_crc_fourth_time: self.invalid_crc_resending_last_time,
+            config.file_hash_check: self.file_hash_check
         }
 
-    def read(self, conn):
-        """ read data from client and parse it"""
-        logging.info("A client has connected.")
-        data = conn.recv(Server.PACKET_SIZE)
-        if data:
-            request_header = protocol.RequestHeader()
-            success = False
-            if not request_header.unpack(data):
-                logging.error("Failed to parse request header!")
-            else:
-                if request_header.code in self.request_handle.keys():
-                    success = self.request_handle[request_header.code](conn, data)  # invoke corresponding handle.
-            if not success:  # returning error depending on failure
-                if request_header.code == config.registration_request:
+    def serve(self, conn):
+        """ Serve requests on a client connection until it fails, idles out or is closed. """
+        logging.info("A client has connected.", extra={"category": "connection"})
+        buffer = self.buffers.acquire(conn)
+        if buffer is None:
+            logging.error("Server is out of receive buffers, dropping client.")
+            self.reaper.unregister(conn)
+            return
+        packet = memoryview(buffer)
+        try:
+            conn.settimeout(config.header_timeout)
+            size = conn.recv_into(buffer)
+            while size and self.dispatch(conn, packet[:size]):
+                # keep the connection open for the next request, up to the idle timeout
+                self.reaper.touch(conn, connections.ConnectionReaper.IDLE)
+                conn.settimeout(config.idle_timeout)
+                size = conn.recv_into(buffer)
+                self.reaper.touch(conn, connections.ConnectionReaper.HEADER)
+                conn.settimeout(config.header_timeout)
+        except socket.timeout:
+            logging.info("Client connection timed out.")
+        except OSError as e:
+            logging.info("Client connection closed due to: %s", e)
+        finally:
+            packet.release()
+            self.buffers.release(conn, buffer)
+            self.reaper.unregister(conn)
+
+    def dispatch(self, conn, data):
+        """ Hand a request to its scheduling lane and wait for it to be handled """
+        request_header = protocol.RequestHeader()
+        if not request_header.unpack(data):
+            return self.read(conn, data)  # answers with the matching error response
+        # the header is in; a request may now wait in its lane for up to the request timeout
+        self.reaper.touch(conn, connections.ConnectionReaper.QUEUED)
+        future = self.scheduler.submit(request_header, self.read, conn, data)
+        if future is None:
+            response_header = protocol.ResponseHeader(config.general_error_response)
+            self.write(conn, response_header.pack())
+            return False
+        return future.result()
+
+    def read(self, conn, data):
+        """ parse a request from client and handle it, return whether it succeeded """
+        with tracing.Trace("request") as trace:
+            success = self.handle_request(conn, data, trace)
+        return success
+
+    def handle_request(self, conn, data, trace):
+        """ handle a request within its trace, answering failures with the matching error response """
+        request_header = protocol.RequestHeader()
+        success = False
+        with tracing.span("parse.header"):
+            parsed = request_header.unpack(data)
+        if not parsed:
+            logging.error("Failed to parse request header!")
+        else:
+            trace.set("request.code", request_header.code)
+            trace.set("client.id", request_header.clientID)
+            if request_header.code in self.request_handle.keys():
+                handle = self.request_handle[request_header.code]
+                trace.set("request.handler", handle.__name__)
+                with logs.RequestContext(handle.__name__, request_header.code, request_header.clientID) as request:
+                    if request_header.code == config.sending_file:
+                        self.reaper.touch(conn, connections.ConnectionReaper.PAYLOAD)
+                        # the file payload is buffered in full, account it against the buffer cap
+                        if self.buffers.reserve(conn, request_header.payload_size):
+                            try:
+                                success = self.sending_file(conn, data)
+                            finally:
+                                self.buffers.unreserve(conn, request_header.payload_size)
+                    else:
+                        success = handle(conn, data)  # invoke corresponding handle.
+                    logging.log(logging.INFO if success else logging.WARNING, "Request handled.",
+                                extra={"duration_ms": request.elapsed_ms(), "success": success})
+        trace.set("request.success", success)
+        if not success:  # returning error depending on failure
+            if request_header.code == config.registration_request:
+                response_header = protocol.ResponseHeader(config.registration_failed)
+                self.write(conn, response_header.pack())
+            if request_header.code == config.reconnection_request:
+                response_header = protocol.ResponseHeader(config.reconnection_request_rejected)
+                self.write(conn, response_header.pack())
+                # TODO: register client as it would be a new client - only if it failed due to not registered yet
+                registered = self.handle_registration_request(conn, data)
+                if not registered:
                     response_header = protocol.ResponseHeader(config.registration_failed)
                     self.write(conn, response_header.pack())
-                if request_header.code == config.reconnection_request:
-                    response_header = protocol.ResponseHeader(config.reconnection_request_rejected)
-                    self.write(conn, response_header.pack())
-                    # TODO: register client as it would be a new client - only if it failed due to not registered yet
-                    registered = self.handle_registration_request(conn, data)
-                    if not registered:
-                        response_header = protocol.ResponseHeader(config.registration_failed)
-                        self.write(conn, response_header.pack())
-                else:
-                    # returning general error
-                    response_header = protocol.ResponseHeader(config.general_error_response)
-                    self.write(conn, response_header.pack())
-                conn.close()
+            else:
+                # returning general error
+                response_header = protocol.ResponseHeader(config.general_error_response)
+                self.write(conn, response_header.pack())
+        return success
 
     def write(self, conn, data):
         """ Send a response to client"""
+        with tracing.span("response.send", size=len(data)):
+            return self.send(conn, data)
+
+    def send(self, conn, data):
+        """ Send data to client in padded packets """
         size = len(data)
         sent = 0
+        self.reaper.touch(conn, connections.ConnectionReaper.WRITE)
+        conn.settimeout(config.write_timeout)
         while sent < size:
             leftover = size - sent
-            if leftover > Server.PACKET_SIZE:
-                leftover = Server.PACKET_SIZE
+            if leftover > config.packet_size:
+                leftover = config.packet_size
             to_send = data[sent:sent + leftover]
-            if len(to_send) < Server.PACKET_SIZE:
-                to_send += bytearray(Server.PACKET_SIZE - len(to_send))
+            if len(to_send) < config.packet_size:
+                to_send += bytearray(config.packet_size - len(to_send))
             try:
                 conn.send(to_send)
                 sent += len(to_send)
             except Exception as err:
-                logging.error(f"Failed to send response to {conn} due to {err}")
+                logging.error("Failed to send response to %s due to %s", conn, err)
                 return False
         logging.info("Response sent successfully.")
         return True
@@ -91,39 +170,50 @@ class Server:
             sock.bind((self.host, self.port))
             sock.listen()
         except Exception as e:
-            logging.error(f"error in creating socket due to: {e}")
+            logging.error("error in creating socket due to: %s", e)
             return False
-        logging.info(f"Server is listening for connections on port {self.port}..")
+        logging.info("Server is listening for connections on port %s..", self.port)
+        self.reaper.start()
+        self.scheduler.start()
+        self.maintenance.start()
+        durability.flusher.start(self.database)
         while True:
             try:
                 client_conn, client_address = sock.accept()
-                client_handler = threading.Thread(target=self.read, args=(client_conn,))
+                if self.reaper.count() >= config.max_connections:
+                    logging.warning("Too many open connections, refusing %s.", client_address)
+                    client_conn.close()
+                    continue
+                self.reaper.register(client_conn, client_address)
+                client_handler = threading.Thread(target=self.serve, args=(client_conn,))
                 client_handler.start()
             except Exception as e:
-                logging.exception(f"Server main loop exception: {e}")
+                logging.exception("Server main loop exception: %s", e)
 
     def handle_registration_request(self, conn, data):
         """ Register a new user. """
         request = protocol.RegistrationRequest()
         response = protocol.RegistrationResponse()
-        if not request.unpack(data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
             logging.error("Registration Request: Failed parsing request.")
             return False
         try:
             if not request.name.isalnum():
-                logging.info(f"Registration Request: Invalid requested username ({request.name}))")
+                logging.info("Registration Request: Invalid requested username (%s))", request.name)
                 return False
             if self.database.client_username_exists(request.name):
-                logging.info(f"Registration Request: Username ({request.name}) already exists.")
+                logging.info("Registration Request: Username (%s) already exists.", request.name)
                 return False
         except:
             logging.error("Registration Request: Failed to connect to database.")
             return False
         client = database.Client(uuid.uuid4().hex, request.name, str(datetime.now()))
         if not self.database.store_client(client):
-            logging.error(f"Registration Request: Failed to store client {request.name}.")
+            logging.error("Registration Request: Failed to store client %s.", request.name)
             return False
-        logging.info(f"Successfully registered client {request.name}.")
+        logging.info("Successfully registered client %s.", request.name)
         response.clientID = client.ID
         response.header.payload_size = config.client_id_size
         return self.write(conn, response.pack())
@@ -132,19 +222,21 @@ class Server:
         """ Receive public key from a new user. """
         request = protocol.SendingPublicKeyRequest()
         response = protocol.SendingPublicKeyResponse()
-        if not request.unpack(data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
             logging.error("Sending Public Key Request: Failed parsing request.")
             return False
         try:
             if not self.database.client_username_exists(request.name):
-                logging.info(f"Sending Public Key Request:: Username ({request.name}) doesn't exist.")
+                logging.info("Sending Public Key Request:: Username (%s) doesn't exist.", request.name)
                 return False
         except:
             logging.error("Sending Public Key Request: Failed to connect to database.")
             return False
         #  update the relevant client with the public key
         try:
-            if not self.database.update_public_key(request.header.clientID):
+            if not self.database.update_public_key(request.header.clientID, request.public_key):
                 logging.error("Sending Public Key Request: Failed to update public key in database")
                 return False
         except:
@@ -154,29 +246,31 @@ class Server:
         aes_key = helpers.generate_aes_key()
         try:
             # save aes key to database for relevant client
-            if not self.database.update_aes_key(request.header.clientID):
+            if not self.database.update_aes_key(request.header.clientID, aes_key):
                 logging.error("Sending Public Key Request: Failed to update aes key in database")
                 return False
         except Exception as e:
-            logging.error(f"Sending Public Key Request: Failed to connect to database due to: {e}.")
+            logging.error("Sending Public Key Request: Failed to connect to database due to: %s.", e)
             return False
         # encrypt aes key
         encrypted_aes_key = helpers.encrypt_aes_key(aes_key, request.public_key)
         response.clientID = request.header.clientID
         response.aes_key = encrypted_aes_key
-        response.header.payload_size = config.client_id_size + config.aes_key_size
+        response.header.payload_size = config.client_id_size + len(encrypted_aes_key)
         return self.write(conn, response.pack())
 
     def handle_reconnection_request(self, conn, data):
         """ Receive reconnection request from a new user. """
         request = protocol.ReconnectionRequest()
         response = protocol.ReconnectionResponse()
-        if not request.unpack(data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
             logging.error("Reconnection Request: Failed parsing request.")
             return False
         try:
             if not self.database.client_username_exists(request.name):
-                logging.info(f"Reconnection Request:: Username ({request.name}) doesn't exist.")
+                logging.info("Reconnection Request:: Username (%s) doesn't exist.", request.name)
                 return False
         except:
             logging.error("Reconnection Request: Failed to connect to database.")
@@ -185,80 +279,159 @@ class Server:
         now = datetime.now()
         try:
             self.database.update_last_seen(request.header.clientID, now)
-            logging.info(f"Reconnection Request: updated LastSeen for client: {request.name}")
+            logging.info("Reconnection Request: updated LastSeen for client: %s", request.name)
         except:
-            logging.error(f"Reconnection Request: Failed to update LastSeen for client: {request.name}.")
+            logging.error("Reconnection Request: Failed to update LastSeen for client: %s.", request.name)
         try:
             # retrieve public_key and aes_key from db
             aes_key = self.database.get_aes_key(request.header.clientID)
             public_key = self.database.get_public_key(request.header.clientID)
         except Exception as e:
-            logging.error(f"Reconnection Request: Failed to retrieve client_id and aes_key due to: {e}")
+            logging.error("Reconnection Request: Failed to retrieve client_id and aes_key due to: %s", e)
+            return False
+        if not aes_key or not public_key:
+            logging.info("Reconnection Request: Client %s has no exchanged keys.", request.name)
             return False
         # encrypt aes_key
         encrypted_aes_key = helpers.encrypt_aes_key(aes_key, public_key)
         response.clientID = request.header.clientID
         response.aes_key = encrypted_aes_key
-        response.header.payload_size = config.client_id_size + config.aes_key_size
+        response.header.payload_size = config.client_id_size + len(encrypted_aes_key)
         return self.write(conn, response.pack())
 
     def sending_file(self, conn, data):
         """ receive a file from a client """
         request = protocol.SendingFileRequest()
         response = protocol.SendingFileResponse()
-        if not request.unpack(conn, data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(conn, data)
+        if not parsed:
             logging.error("Send File Request: Failed to parse request header!")
+            return False
         try:
             # decrypt message content
             file_content = request.message_content
             client_id = request.header.clientID
             aes_key = self.database.get_aes_key(client_id)
+            if not aes_key:
+                logging.error("Send File Request: No aes key stored for client.")
+                return False
             decrypted_msg_content = helpers.decrypt_file_content(file_content, aes_key)
-            # save file to RAM
-            file_path = helpers.save_to_ram(decrypted_msg_content, request.file_name)
             # calc cksum
             cksum = helpers.cksum(decrypted_msg_content)
-            try:
-                # store file details into db
-                verified = False
-                file_details = self.database.FILES(client_id, request.file_name, file_path, verified)
-                self.database.file_details(file_details)
-            except Exception as err:
-                logging.error(f"Send File Request: Failed to store file details due to: {err}.")
-                return False
+            # the file is named by its content hash so identical uploads share one copy
+            content_hash = helpers.content_hash(decrypted_msg_content)
+            file_path = helpers.stored_path(content_hash.hex())
+            # maintenance can't remove the content between saving it and referencing it
+            with self.database.content_lock(file_path):
+                # save file to RAM
+                helpers.save_to_ram(decrypted_msg_content, content_hash.hex())
+                # index content so identical uploads can skip the transfer
+                try:
+                    self.database.store_content(content_hash, len(decrypted_msg_content), file_path, cksum)
+                except Exception as err:
+                    logging.error("Send File Request: Failed to index file content due to: %s.", err)
+                try:
+                    # store file details into db
+                    verified = False
+                    file_details = database.File(client_id.hex(), request.file_name, file_path, verified)
+                    if not self.database.file_details(file_details):
+                        logging.error("Send File Request: Failed to store file details.")
+                        return False
+                except Exception as err:
+                    logging.error("Send File Request: Failed to store file details due to: %s.", err)
+                    return False
 
             # update LastSeen for client
             now = datetime.now()
             try:
                 self.database.update_last_seen(request.header.clientID, now)
-                logging.info(f"Send File Request: updated LastSeen for client")
+                logging.info("Send File Request: updated LastSeen for client")
             except:
-                logging.error(f"Send File Request: Failed to update LastSeen for client.")
+                logging.error("Send File Request: Failed to update LastSeen for client.")
             response.clientID = client_id
             response.content_size = request.content_size
             response.file_name = request.file_name
             response.cksum = cksum
-            response.header.payload_size = config.client_id_size
+            response.header.payload_size = config.client_id_size + config.content_size + config.cksum_size
             return self.write(conn, response.pack())
         except Exception as err:
-            logging.error(f"Send File Request: Failed due to: {err}.")
+            logging.error("Send File Request: Failed due to: %s.", err)
+            return False
+
+    def file_hash_check(self, conn, data):
+        """ Check whether a file's content is already stored, so its upload can be skipped. """
+        request = protocol.FileHashCheckRequest()
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
+            logging.error("File Hash Check Request: Failed parsing request.")
             return False
+        client_id = request.header.clientID
+        # maintenance can't remove the content between finding it and referencing it
+        with self.database.content_lock(helpers.stored_path(request.content_hash.hex())):
+            try:
+                stored = self.database.get_stored_content(request.content_hash, request.content_size)
+            except Exception as err:
+                logging.error("File Hash Check Request: Failed to connect to database due to: %s.", err)
+                return False
+            if stored is not None:
+                path_name = stored[0].decode('utf-8') if isinstance(stored[0], bytes) else stored[0]
+                if not os.path.exists(path_name):
+                    # uploads live in /tmp and don't survive a reboot; have the client send the content again
+                    logging.info("File Hash Check Request: Stored content is gone, dropping its index entry.")
+                    self.database.delete_content(path_name)
+                    stored = None
+            if stored is None:
+                logging.info("File Hash Check Request: Content not stored yet, waiting for upload.")
+                response = protocol.FileContentUnknownResponse()
+                response.clientID = client_id
+                response.header.payload_size = config.client_id_size
+                return self.write(conn, response.pack())
+            cksum = stored[1]
+            try:
+                # store file details pointing at the already stored content
+                verified = False
+                file_details = database.File(client_id.hex(), request.file_name, path_name, verified)
+                if not self.database.file_details(file_details):
+                    logging.error("File Hash Check Request: Failed to store file details.")
+                    return False
+            except Exception as err:
+                logging.error("File Hash Check Request: Failed to store file details due to: %s.", err)
+                return False
+        # update LastSeen for client
+        now = datetime.now()
+        try:
+            self.database.update_last_seen(client_id, now)
+            logging.info("File Hash Check Request: updated LastSeen for client")
+        except:
+            logging.error("File Hash Check Request: Failed to update LastSeen for client.")
+        logging.info("File Hash Check Request: Content already stored, skipped upload.")
+        response = protocol.SendingFileResponse()
+        response.clientID = client_id
+        response.content_size = request.content_size
+        response.file_name = request.file_name
+        response.cksum = cksum
+        response.header.payload_size = config.client_id_size + config.content_size + config.cksum_size
+        return self.write(conn, response.pack())
 
     def sending_valid_crc_request(self, conn, data):
         """ Receive valid crc request. """
         request = protocol.ValidCRCRequest()
         response = protocol.CRCResponse()
-        if not request.unpack(data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
             logging.error("Valid CRC Request: Failed parsing request.")
             return False
         # update LastSeen and verified CRC columns for client
         now = datetime.now()
         try:
             self.database.update_last_seen(request.header.clientID, now)
-            self.database.update_verified_true(request.header.clientID)
-            logging.info(f"Valid CRC Request: updated LastSeen and Verified to True for client.")
+            self.database.update_verified_true(request.header.clientID, request.file_name)
+            logging.info("Valid CRC Request: updated LastSeen and Verified to True for client.")
         except:
-            logging.error(f"Valid CRC Request: Failed to update db for client.")
+            logging.error("Valid CRC Request: Failed to update db for client.")
         response.clientID = request.header.clientID
         response.header.payload_size = config.client_id_size
         return self.write(conn, response.pack())
@@ -267,19 +440,22 @@ class Server:
         """ Receive invalid crc request for the 4th time. """
         request = protocol.InvalidCRCRequest()
         response = protocol.CRCResponse()
-        if not request.unpack(data):
+        with tracing.span("parse.payload"):
+            parsed = request.unpack(data)
+        if not parsed:
             logging.error("Invalid CRC Request: Failed parsing request.")
             return False
         # update LastSeen column for client
         now = datetime.now()
         try:
             self.database.update_last_seen(request.header.clientID, now)
-            logging.info(f"Invalid CRC Request: updated LastSeen for client.")
+            logging.info("Invalid CRC Request: updated LastSeen for client.")
         except:
-            logging.error(f"Invalid CRC Request: Failed to update db for client.")
+            logging.error("Invalid CRC Request: Failed to update db for client.")
         response.clientID = request.header.clientID
         response.header.payload_size = config.client_id_size
         return self.write(conn, response.pack())
 
-
-
+    def invalid_crc_resending_last_time(self, conn, data):
+        """ Receive the last invalid crc request, after which the client gives up on the file. """
+        return self.invalid_crc_resending_request(conn, data)
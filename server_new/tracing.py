@@ -0,0 +1,163 @@
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import config
+
+config = config.get()
+
+SERVICE_NAME = "file-server"
+
+context = threading.local()
+exporter = logging.getLogger("tracing")
+exporter.propagate = False
+enabled = False
+
+
+def attribute(key, value):
+    """ Encode a span attribute the way OpenTelemetry's JSON encoding does """
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    if isinstance(value, bytes):
+        value = value.hex()
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    def __init__(self, trace_id, name, parent_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_json(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # internal; the root span is marked as server
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        else:
+            span["kind"] = 2
+        return span
+
+
+class Trace:
+    """ Trace of one request. Spans opened with span() while it is active become its children. It is exported
+    when head sampling picked it or when it took at least Config.trace_slow_ms. """
+
+    def __init__(self, name, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = random.random() < config.trace_sample_rate
+        self.root = Span(self.trace_id, name, None, attributes)
+        self.spans = []
+        self.stack = []
+
+    def __enter__(self):
+        if enabled:
+            self.root.start = time.time_ns()
+            self.stack.append(self.root)
+            context.trace = self
+        return self.root
+
+    def __exit__(self, exc_type, exc, tb):
+        if not enabled:
+            return False
+        context.trace = None
+        self.root.end = time.time_ns()
+        if exc is not None:
+            self.root.error = str(exc)
+        self.spans.append(self.root)
+        if self.sampled or (self.root.end - self.root.start) >= config.trace_slow_ms * 1_000_000:
+            export(self.spans)
+        return False
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ Time the enclosed block as a child span of the active trace; does nothing without one """
+    trace = getattr(context, 'trace', None)
+    if trace is None:
+        yield None
+        return
+    current = Span(trace.trace_id, name, trace.stack[-1].span_id, attributes)
+    trace.stack.append(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = str(e)
+        raise
+    finally:
+        current.end = time.time_ns()
+        trace.stack.pop()
+        trace.spans.append(current)
+
+
+def export(spans):
+    """ Hand a finished trace to the background exporter as one OTLP JSON line """
+    message = {
+        "resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "server_new"}, "spans": [s.to_json() for s in spans]}],
+        }]
+    }
+    exporter.info("%s", LazyJson(message))
+
+
+class LazyJson:
+    """ Serialized by the exporter thread, not the request thread (see ExportHandler) """
+
+    def __init__(self, message):
+        self.message = message
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:  # formatted twice: once to check for rotation, once to write
+            self.text = json.dumps(self.message, separators=(",", ":"))
+        return self.text
+
+
+class ExportHandler(logging.handlers.QueueHandler):
+    """ Queue trace records unmerged. Unlike log arguments, a trace message is built for its export alone and never
+    changed afterwards, so it is safe to serialize on the exporter thread. """
+
+    def prepare(self, record):
+        return record
+
+
+def setup():
+    """ Export traces to Config.trace_file, rotated by size, from a background thread. Return the listener. """
+    global enabled
+    records = queue.SimpleQueue()
+    handler = logging.handlers.RotatingFileHandler(config.trace_file, maxBytes=config.trace_file_max_bytes,
+                                                   backupCount=config.trace_file_backups)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    exporter.addHandler(ExportHandler(records))
+    exporter.setLevel(logging.INFO)
+    listener.start()
+    enabled = True
+    return listener